@@ -1,12 +1,37 @@
 # filename: main.py
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
-from redis_1 import get_value
+from redis import RedisError
+import redis_1
+from redis_1 import FETCH_LATENCY, VERDICT_CACHE, MessageNotFound, get_value
+from auto import CASCADE_DECISIONS, LLM_FLIGHTS, OLLAMA
+from llm_dispatcher import DispatcherBusy, DispatcherClosed
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, Registry, instrument_app
 import datetime
 
 # strat1 = datetime.datetime.now()
 # print("request_type#fast api start" + str(strat1))
-app = FastAPI()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await redis_1.close()
+    OLLAMA.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+# Latency histogram per endpoint + Server-Timing header (llm phase from auto.py)
+METRICS = Registry()
+instrument_app(app, METRICS, "request_type")
+METRICS.register(CASCADE_DECISIONS.collect)
+METRICS.register(VERDICT_CACHE.collect)
+METRICS.register(FETCH_LATENCY.collect)
+METRICS.register(LLM_FLIGHTS.collect)
+METRICS.register(OLLAMA.collect)
 
 
 # Define request model
@@ -21,6 +46,7 @@ class OutputData(BaseModel):
     # result: str
     signal: str
     value: str
+    tier: str  # "rules" or "llm": which stage of the cascade decided
 
 
 @app.post("/process", response_model=OutputData)
@@ -28,15 +54,28 @@ async def process_text(data: InputData):
     # You can modify this logic based on your processing
     input_text = data.Massage_Id
     print("input_text === ", input_text)
-    output_text = get_value(input_text)  # example: convert input to uppercase
+    try:
+        verdict = await get_value(input_text, data.Tanent_id)
+    except MessageNotFound:
+        raise HTTPException(status_code=404, detail=f"No message stored under id {input_text!r}.")
+    except RedisError as exc:
+        print("message fetch failed:", exc)
+        raise HTTPException(status_code=503, detail="Message store unavailable.")
+    except (DispatcherBusy, DispatcherClosed) as exc:
+        raise HTTPException(status_code=503, detail=str(exc))
     # end = datetime.datetime.now()
     # print("request_type#fast api end" + str(end))
     # print("total time taken by fast api = ", (end - strat1))
     # return {"result": output_text}
-    return {"signal": "request_type", "value": output_text}
+    return {"signal": "request_type", "value": verdict.label, "tier": verdict.tier}
 
 
 # Root endpoint (optional)
 @app.get("/")
 async def root():
     return {"message": "FastAPI is running!"}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(METRICS.render(), media_type=METRICS_CONTENT_TYPE)
@@ -1,7 +1,17 @@
 from langchain_core.messages import SystemMessage, HumanMessage
 from langchain_community.llms import Ollama
 from prompt import a1, a2  # , sm
+from metrics import Counter, format_metric, timing_phase
+from llm_dispatcher import OllamaDispatcher
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Optional
+import mailarmor_classifier as rule_engine
+import asyncio
 import datetime
+import hashlib
+import os
+import threading
 
 # from langchain_ollama import OllamaLLM
 
@@ -10,15 +20,29 @@ import datetime
 
 # Qa server ip = base_url="http://207.180.193.215:11434"
 # mistral:7b-instruct #"http://13.233.69.94:11434"
-llm = Ollama(
-    base_url="http://13.233.69.94:11434",
-    model="qwen2.5:3b-instruct",
-    temperature=0.0,
-    top_p=0.05,
-    num_predict=3,
-)
+OLLAMA_URL = os.environ.get("MAILARMOR_OLLAMA_URL", "http://13.233.69.94:11434")
+LLM_MODEL = "qwen2.5:3b-instruct"
+LLM_OPTIONS = {"temperature": 0.0, "top_p": 0.05, "num_predict": 3}
+PROMPT_VERSION = hashlib.sha256(a2.encode()).hexdigest()[:12]  # changes whenever the agent2 prompt does
+
+llm = Ollama(base_url=OLLAMA_URL, model=LLM_MODEL, **LLM_OPTIONS)
 llm.invoke("warmup")
 
+# agent2 goes through the dispatcher: bounded parallelism against the model
+# server, a bounded queue in front of it and one pooled HTTP client
+LLM_DISPATCHER = os.environ.get("MAILARMOR_LLM_DISPATCHER", "1") == "1"
+OLLAMA = OllamaDispatcher(
+    OLLAMA_URL,
+    LLM_MODEL,
+    LLM_OPTIONS,
+    concurrency=int(os.environ.get("MAILARMOR_LLM_CONCURRENCY", "4")),
+    queue_size=int(os.environ.get("MAILARMOR_LLM_QUEUE_SIZE", "256")),
+    batch_window=float(os.environ.get("MAILARMOR_LLM_BATCH_WINDOW_MS", "5")) / 1000,
+    timeout=float(os.environ.get("MAILARMOR_LLM_TIMEOUT", "30")),
+    wait_timeout=float(os.environ.get("MAILARMOR_LLM_WAIT_TIMEOUT", "120")),
+    prefix="request_type_llm_dispatcher",
+)
+
 
 def agent1(email_text):
     """Classify email content after summarization."""
@@ -30,7 +54,8 @@ def agent1(email_text):
 
     # Step 2: Classify the summarized text
     messages = [SystemMessage(content=a1), HumanMessage(content=email_text)]
-    response = llm.invoke(messages)
+    with timing_phase("llm"):
+        response = llm.invoke(messages)
 
     end_time = datetime.datetime.now()
     print(f"#summary_langchain#end_classification {end_time}")
@@ -57,12 +82,12 @@ def agent2(email_text):
 
     # Step 2: Classify the summarized text
     # messages = [SystemMessage(content=a2), HumanMessage(content=email_text)]
-    flat_prompt = f"""{a2}
-
-                    EMAIL:
-                    {email_text}
-                    """
-    response = llm.invoke(flat_prompt)
+    flat_prompt = agent2_prompt(email_text)
+    with timing_phase("llm"):
+        if LLM_DISPATCHER:
+            response = OLLAMA.generate(flat_prompt)
+        else:
+            response = llm.invoke(flat_prompt)
 
     # end_time = datetime.datetime.now()
     # print(f"#summary_langchain#end_classification {end_time}")
@@ -72,7 +97,167 @@ def agent2(email_text):
     return response
 
 
-def classify_email(email_text: str):
+def agent2_prompt(email_text):
+    return f"""{a2}
+
+                    EMAIL:
+                    {email_text}
+                    """
+
+
+async def agent2_async(email_text):
+    """agent2() for the event loop: awaits the dispatcher instead of blocking a thread."""
+    flat_prompt = agent2_prompt(email_text)
+    with timing_phase("llm"):
+        if LLM_DISPATCHER:
+            return await OLLAMA.agenerate(flat_prompt)
+        return await asyncio.to_thread(llm.invoke, flat_prompt)
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one.
+
+    The first caller for a key (the leader) runs the function; callers that
+    arrive while it runs wait for its result (or exception) instead of
+    starting their own call. Nothing is kept once the call finishes. `do`
+    takes a plain function, `ado` a coroutine function; both share the keys.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._inflight = {}  # key -> Future of the leader's call
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+        self.waiting = 0
+
+    def do(self, key, fn, *args):
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+                self.waiting += 1
+
+        if not leader:
+            try:
+                with timing_phase("llm"):
+                    return future.result()
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+
+        try:
+            result = fn(*args)
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    async def ado(self, key, fn, *args):
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+                self.waiting += 1
+
+        if not leader:
+            try:
+                with timing_phase("llm"):
+                    # shielded: a waiter giving up must not cancel the shared call
+                    return await asyncio.shield(asyncio.wrap_future(future))
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+
+        # The call runs as its own task, so the waiters still get its result
+        # if the leader is cancelled
+        task = asyncio.ensure_future(fn(*args))
+        task.add_done_callback(lambda task: self._settle(key, future, task))
+        return await asyncio.shield(task)
+
+    def _settle(self, key, future, task):
+        with self._lock:
+            del self._inflight[key]
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+    def collect(self):
+        with self._lock:
+            inflight, waiting, leaders, coalesced = len(self._inflight), self.waiting, self.leaders, self.coalesced
+        return (
+            format_metric(f"{self.prefix}_inflight", "gauge", "Distinct calls in flight.", [({}, inflight)])
+            + format_metric(f"{self.prefix}_waiters", "gauge", "Callers waiting on an identical call in flight.",
+                            [({}, waiting)])
+            + format_metric(f"{self.prefix}_calls_total", "counter",
+                            "Calls by role: leader (ran the call) or coalesced (shared its result).",
+                            [({"role": "leader"}, leaders), ({"role": "coalesced"}, coalesced)])
+        )
+
+
+# Identical bodies arriving together (a campaign) share one LLM call
+LLM_FLIGHTS = SingleFlight("request_type_llm")
+
+
+# Cascade: the rule engine answers first (microseconds); only results it is
+# unsure about go on to the LLM (hundreds of ms to seconds).
+CASCADE = os.environ.get("MAILARMOR_CASCADE", "1") == "1"
+CASCADE_THRESHOLD_MARGIN = int(os.environ.get("MAILARMOR_CASCADE_THRESHOLD_MARGIN", "5"))  # points over threshold
+CASCADE_RUNNER_UP_MARGIN = int(os.environ.get("MAILARMOR_CASCADE_RUNNER_UP_MARGIN", "5"))  # lead over runner-up
+CASCADE_PARTIAL_FRACTION = float(os.environ.get("MAILARMOR_CASCADE_PARTIAL_FRACTION", "0.5"))  # of a threshold
+
+CASCADE_DECISIONS = Counter("request_type_cascade_decisions_total",
+                            "Classifications by the tier that decided them and why.", ("tier", "reason"))
+
+
+@dataclass
+class Verdict:
+    label: str
+    tier: str    # "rules" or "llm"
+    reason: str  # why that tier decided, see rule_ambiguity
+
+
+def rule_ambiguity(result: rule_engine.ClassificationResult) -> Optional[str]:
+    """Why a rule engine result needs the LLM, or None if it can stand.
+
+    A label is kept when its score clears the threshold by
+    CASCADE_THRESHOLD_MARGIN and the runner-up by CASCADE_RUNNER_UP_MARGIN;
+    "none" is kept unless some category got CASCADE_PARTIAL_FRACTION of the
+    way to its threshold. Results with skipped regexes always go on.
+    """
+    rules = result.rules
+    if result.regex_budget_exceeded:
+        return "regex_budget"
+    if result.label == "none":
+        for score, threshold in zip(result.category_scores, rules.category_thresholds):
+            if score > 0 and score >= threshold * CASCADE_PARTIAL_FRACTION:
+                return "partial_hits"
+        return None
+    threshold = rules.category_thresholds[rules.categories.index(result.label)]
+    if result.score < threshold + CASCADE_THRESHOLD_MARGIN:
+        return "near_threshold"
+    if result.runner_up is not None and result.score - result.runner_up_score < CASCADE_RUNNER_UP_MARGIN:
+        return "close_runner_up"
+    return None
+
+
+def classify_email(email_text: str, tenant_id: Optional[str] = None, llm_classify=agent2) -> Verdict:
     # Step 1: Check if request is present
     # presence_result = agent1(email_text)
 
@@ -80,8 +265,50 @@ def classify_email(email_text: str):
     #     return "none"
     # else:
     #     # Step 2: If request present, classify its type
-    type_result = agent2(email_text)
-    return type_result
+    if not CASCADE:
+        CASCADE_DECISIONS.inc("llm", "cascade_off")
+        return Verdict(llm_classify(email_text), "llm", "cascade_off")
+
+    verdict, reason = rule_tier(email_text, tenant_id)
+    if verdict is not None:
+        return verdict
+
+    type_result = llm_classify(email_text)
+    CASCADE_DECISIONS.inc("llm", reason)
+    return Verdict(type_result, "llm", reason)
+
+
+async def classify_email_async(email_text: str, tenant_id: Optional[str] = None,
+                               llm_classify=agent2_async) -> Verdict:
+    """classify_email() for the event loop: only the rule engine runs in a worker
+    thread; `llm_classify` is a coroutine function and is awaited."""
+    if not CASCADE:
+        CASCADE_DECISIONS.inc("llm", "cascade_off")
+        return Verdict(await llm_classify(email_text), "llm", "cascade_off")
+
+    verdict, reason = await asyncio.to_thread(rule_tier, email_text, tenant_id)
+    if verdict is not None:
+        return verdict
+
+    type_result = await llm_classify(email_text)
+    CASCADE_DECISIONS.inc("llm", reason)
+    return Verdict(type_result, "llm", reason)
+
+
+def rule_tier(email_text: str, tenant_id: Optional[str] = None) -> tuple[Optional[Verdict], Optional[str]]:
+    """Run the rule engine: its verdict if it can stand, else None and why the LLM is needed."""
+    try:
+        rules = rule_engine.TENANT_RULES.get(tenant_id)
+    except ValueError as exc:
+        print(f"Tenant rules unavailable, using the base rules: {exc}")
+        rules = rule_engine.get_active_rules()
+    result = rule_engine.classify(email_text, rules)  # reports its own preprocess/match/regex phases
+    reason = rule_ambiguity(result)
+    if reason is None:
+        reason = "no_hits" if result.label == "none" else "confident"
+        CASCADE_DECISIONS.inc("rules", reason)
+        return Verdict(result.label, "rules", reason), reason
+    return None, reason
 
 
 # print(
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+Rule Engine Benchmark
+=====================
+Runs preprocess(), rule matching, classify() and the bulk path in-process on a
+synthetic corpus built from the samples in generate_test_csv.py, and reports
+throughput, per-email latency percentiles and peak traced memory per stage.
+Each phrase matcher (substring, ngram) is measured side by side, together
+with how often their labels agree.
+
+Usage:
+    python3 benchmark.py                                  # 2000 emails, default mix
+    python3 benchmark.py --count 20000 --mix short=0.5,long=0.3,html=0.2
+    python3 benchmark.py --output bench_baseline.json     # save a baseline
+    python3 benchmark.py --compare bench_baseline.json    # compare against it
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import mailarmor_classifier as engine
+from generate_test_csv import THREAT_SAMPLES, LEGITIMATE_SAMPLES
+
+ALL_SAMPLES = [sample for samples in THREAT_SAMPLES.values() for sample in samples] + LEGITIMATE_SAMPLES
+
+HTML_HEAD = """<html><head><meta charset="utf-8"><style type="text/css">
+body {{ margin: 0; padding: 0; font-family: Arial, Helvetica, sans-serif; }}
+table.wrapper {{ width: 100%; border-collapse: collapse; }} td.cell {{ padding: 8px 16px; color: #333333; }}
+{rules}
+</style><script type="text/javascript">
+window.dataLayer = window.dataLayer || []; function track(e) {{ dataLayer.push({{"event": e}}); }}
+</script></head><body><table class="wrapper">"""
+HTML_FOOT = """</table><p style="font-size:10px">&copy; 2024 Example&nbsp;Corp &middot;
+<a href="https://example.com/unsubscribe?id=123">Unsubscribe</a></p></body></html>"""
+
+
+# ---------------------------------------------------------------------------
+# Corpus
+# ---------------------------------------------------------------------------
+
+def _long_text(rnd: random.Random, chars: int) -> str:
+    parts, size = [], 0
+    while size < chars:
+        subject, body = rnd.choice(ALL_SAMPLES)
+        parts.append(body)
+        size += len(body) + 1
+    return " ".join(parts)
+
+
+def _html_text(rnd: random.Random, chars: int) -> str:
+    style_rules = "\n".join(f".c{i} {{ color: #{rnd.randrange(0xFFFFFF):06x}; }}" for i in range(200))
+    rows = [
+        f'<tr><td class="cell c{rnd.randrange(200)}"><span>{sentence.strip()}.</span></td></tr>'
+        for sentence in _long_text(rnd, chars).split(".") if sentence.strip()
+    ]
+    return HTML_HEAD.format(rules=style_rules) + "\n".join(rows) + HTML_FOOT
+
+
+def build_corpus(count: int, mix: dict[str, float], long_chars: int, seed: int) -> list[tuple[str, str]]:
+    """Return `count` (kind, text) pairs drawn from the `mix` of short/long/html bodies."""
+    rnd = random.Random(seed)
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    corpus = []
+    for _ in range(count):
+        kind = rnd.choices(kinds, weights)[0]
+        subject, body = rnd.choice(ALL_SAMPLES)
+        if kind == "long":
+            body = _long_text(rnd, long_chars)
+        elif kind == "html":
+            body = _html_text(rnd, long_chars)
+        corpus.append((kind, f"{subject} {body}"))
+    return corpus
+
+
+# ---------------------------------------------------------------------------
+# Measurement
+# ---------------------------------------------------------------------------
+
+def _percentile(sorted_values: list[int], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index] / 1000  # ns -> us
+
+
+def _per_email_stage(func, inputs: list) -> dict:
+    latencies = []
+    start = time.perf_counter()
+    for item in inputs:
+        t0 = time.perf_counter_ns()
+        func(item)
+        latencies.append(time.perf_counter_ns() - t0)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "emails_per_sec": round(len(inputs) / elapsed, 1) if elapsed else 0.0,
+        "mean_us": round(elapsed / len(inputs) * 1e6, 3) if inputs else 0.0,
+        "p50_us": _percentile(latencies, 50),
+        "p90_us": _percentile(latencies, 90),
+        "p99_us": _percentile(latencies, 99),
+        "max_us": _percentile(latencies, 100),
+    }
+
+
+def _batch_stage(func, inputs: list) -> dict:
+    start = time.perf_counter()
+    func(inputs)
+    elapsed = time.perf_counter() - start
+    # One call for the whole batch: no per-email latency distribution
+    return {
+        "emails_per_sec": round(len(inputs) / elapsed, 1) if elapsed else 0.0,
+        "mean_us": round(elapsed / len(inputs) * 1e6, 3) if inputs else 0.0,
+        "p50_us": None,
+        "p90_us": None,
+        "p99_us": None,
+        "max_us": None,
+    }
+
+
+def _peak_memory_kib(func, inputs: list, batch: bool) -> float:
+    tracemalloc.start()
+    try:
+        if batch:
+            func(inputs)
+        else:
+            for item in inputs:
+                func(item)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return round(peak / 1024, 1)
+
+
+def _compile(matcher: str) -> "engine.CompiledRules":
+    active = engine.get_active_rules()
+    return active if active.matcher == matcher else engine.CompiledRules(dict(active.rules), matcher)
+
+
+def run_benchmark(corpus: list[tuple[str, str]], matchers: list[str], parallel: bool,
+                  alloc_sample: int, repeat: int) -> dict:
+    # Measure the engine, not the result cache
+    engine.RESULT_CACHE.max_size = 0
+    engine.RESULT_CACHE.clear()
+
+    texts = [text for _, text in corpus]
+    preprocessed = [engine.preprocess(text) for text in texts]
+
+    stages = {"preprocess": (engine.preprocess, texts, False)}
+    for matcher in matchers:
+        rules = _compile(matcher)
+        # Stages of the default substring matcher keep their plain names, so older baselines still compare
+        suffix = "" if matcher == "substring" else f"[{matcher}]"
+        stages.update({
+            f"match{suffix}": (lambda text, rules=rules: engine.match_features(text, rules), preprocessed, False),
+            f"classify{suffix}": (lambda text, rules=rules: engine.classify(text, rules), texts, False),
+            f"classify_pruned{suffix}": (lambda text, rules=rules: engine.classify(text, rules, prune=True),
+                                         texts, False),
+            f"classify_many{suffix}": (lambda batch, rules=rules: engine.classify_many(batch, rules), texts, True),
+        })
+        if parallel:
+            stages[f"classify_many_parallel{suffix}"] = (
+                lambda batch, rules=rules: engine.classify_many_parallel(batch, rules), texts, True)
+
+    results = {}
+    for name, (func, inputs, batch) in stages.items():
+        runs = [_batch_stage(func, inputs) if batch else _per_email_stage(func, inputs)
+                for _ in range(repeat)]
+        stats = max(runs, key=lambda run: run["emails_per_sec"])
+        stats["peak_kib"] = _peak_memory_kib(func, inputs[:alloc_sample], batch)
+        results[name] = stats
+    engine.shutdown_bulk_pool()
+    return results
+
+
+def label_agreement(corpus: list[tuple[str, str]], matchers: list[str]) -> dict[str, float]:
+    """Share of emails each matcher labels the same as the first one in `matchers`."""
+    texts = [text for _, text in corpus]
+    reference = engine.classify_many(texts, _compile(matchers[0])).labels
+    agreement = {}
+    for matcher in matchers[1:]:
+        labels = engine.classify_many(texts, _compile(matcher)).labels
+        agreement[matcher] = round(sum(a == b for a, b in zip(reference, labels)) / len(texts), 4) if texts else 1.0
+    return agreement
+
+
+def _git_commit() -> str:
+    try:
+        # The engine's checkout, wherever the benchmark is started from
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+# ---------------------------------------------------------------------------
+# Reporting
+# ---------------------------------------------------------------------------
+
+def print_report(report: dict) -> None:
+    meta = report["meta"]
+    print(f"\nCommit {meta['commit']} | ruleset {meta['ruleset_version']} | "
+          f"{meta['count']} emails ({meta['corpus_chars']} chars) | Python {meta['python']}")
+    columns = ("mean_us", "p50_us", "p90_us", "p99_us")
+    print(f"{'stage':24s} {'emails/s':>10s} {'mean us':>10s} {'p50 us':>10s} {'p90 us':>10s} "
+          f"{'p99 us':>10s} {'peak KiB':>10s}")
+    for name, stats in report["stages"].items():
+        cells = " ".join("         -" if stats[col] is None else f"{stats[col]:10.1f}" for col in columns)
+        print(f"{name:24s} {stats['emails_per_sec']:10.1f} {cells} {stats['peak_kib']:10.1f}")
+    matchers = meta.get("matchers", [])
+    for matcher, share in meta.get("label_agreement", {}).items():
+        print(f"Labels from {matcher} agree with {matchers[0]} on {share:.1%} of emails")
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> bool:
+    """Print throughput deltas against `baseline`; return False if any stage regressed beyond `tolerance`."""
+    print(f"\nCompared with baseline from commit {baseline['meta']['commit']}:")
+    ok = True
+    for name, stats in report["stages"].items():
+        old = baseline["stages"].get(name)
+        if not old or not old["emails_per_sec"]:
+            print(f"  {name:24s} (no baseline)")
+            continue
+        change = stats["emails_per_sec"] / old["emails_per_sec"] - 1
+        flag = ""
+        if change < -tolerance:
+            flag = "  REGRESSION"
+            ok = False
+        print(f"  {name:24s} {old['emails_per_sec']:10.1f} -> {stats['emails_per_sec']:10.1f} emails/s "
+              f"({change:+.1%}){flag}")
+    return ok
+
+
+def _parse_mix(value: str) -> dict[str, float]:
+    mix = {}
+    for part in value.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in ("short", "long", "html"):
+            raise argparse.ArgumentTypeError(f"Unknown body kind {kind!r} (use short, long, html)")
+        mix[kind] = float(weight)
+    return mix
+
+
+def _parse_matchers(value: str) -> list[str]:
+    matchers = value.split(",")
+    for matcher in matchers:
+        if matcher not in engine.MATCHERS:
+            raise argparse.ArgumentTypeError(f"Unknown matcher {matcher!r} (use {', '.join(engine.MATCHERS)})")
+    return matchers
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Mailarmor rule engine in-process")
+    parser.add_argument("-c", "--count", type=int, default=2000, help="Number of emails in the corpus")
+    parser.add_argument("--mix", type=_parse_mix, default="short=0.7,long=0.2,html=0.1",
+                        help="Body length distribution, e.g. short=0.7,long=0.2,html=0.1")
+    parser.add_argument("--long-chars", type=int, default=20000, help="Approximate text size of long/html bodies")
+    parser.add_argument("--seed", type=int, default=42, help="Corpus random seed")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per stage; the fastest is reported")
+    parser.add_argument("--matchers", type=_parse_matchers, default="substring,ngram",
+                        help="Phrase matchers to benchmark side by side (default substring,ngram)")
+    parser.add_argument("--parallel", action="store_true", help="Also benchmark the process-pool bulk path")
+    parser.add_argument("--alloc-sample", type=int, default=200, help="Emails per stage traced for peak memory")
+    parser.add_argument("-o", "--output", help="Write the report as JSON (a baseline for --compare)")
+    parser.add_argument("--compare", help="Baseline JSON to compare throughput against")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="Allowed throughput drop vs baseline before failing (default 0.10)")
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.count, args.mix, args.long_chars, args.seed)
+    report = {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "ruleset_version": engine.get_active_rules().version,
+            "count": args.count,
+            "mix": args.mix,
+            "long_chars": args.long_chars,
+            "seed": args.seed,
+            "repeat": args.repeat,
+            "corpus_chars": sum(len(text) for _, text in corpus),
+            "matchers": args.matchers,
+            "label_agreement": label_agreement(corpus, args.matchers),
+        },
+        "stages": run_benchmark(corpus, args.matchers, args.parallel, args.alloc_sample, args.repeat),
+    }
+    print_report(report)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nReport written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if not compare(report, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
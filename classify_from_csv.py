@@ -98,7 +98,7 @@ def classify_single(email: Dict, include_debug: bool = False) -> Dict:
         }
 
 def classify_bulk(emails: List[Dict], include_debug: bool = False) -> List[Dict]:
-    """Classify multiple emails using bulk endpoint (max 100)"""
+    """Classify multiple emails using bulk endpoint (size-limited, no email cap)"""
     payload = {
         "emails": [
             {
@@ -111,7 +111,7 @@ def classify_bulk(emails: List[Dict], include_debug: bool = False) -> List[Dict]
     }
 
     try:
-        response = requests.post(BULK_API_URL, json=payload, timeout=30)
+        response = requests.post(BULK_API_URL, json=payload, timeout=300)
         response.raise_for_status()
         return response.json()['results']
     except Exception as e:
@@ -126,8 +126,8 @@ def process_emails(emails: List[Dict], include_debug: bool = False, use_bulk: bo
 
     results = []
 
-    # Try bulk processing first (if enabled and <= 100 emails)
-    if use_bulk and len(emails) <= 100:
+    # Try bulk processing first (if enabled)
+    if use_bulk:
         print(f"{Colors.BLUE}🚀 Using bulk classification for faster processing...{Colors.END}\n")
         bulk_results = classify_bulk(emails, include_debug)
 
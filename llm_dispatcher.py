@@ -0,0 +1,258 @@
+"""
+Ollama Dispatcher
+=================
+Sends generation requests to an Ollama server with bounded parallelism: a
+bounded queue in front, at most `concurrency` generations in flight, and one
+pooled HTTP client. The dispatcher runs its own event loop in a background
+thread; threaded callers block in `generate`, callers on another event loop
+(the server's) await `agenerate` without holding a thread.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError, TimeoutError as FutureTimeout
+from typing import Optional
+
+import httpx
+
+from metrics import Histogram, current_timing, format_metric
+
+
+class DispatcherBusy(RuntimeError):
+    """The request queue is full; the model server is already saturated."""
+
+
+class DispatcherClosed(RuntimeError):
+    """The dispatcher was closed; it takes no new requests and failed the pending ones."""
+
+
+class OllamaDispatcher:
+    """Bounded-concurrency client for Ollama's /api/generate.
+
+    At most `queue_size` requests wait for a slot, counting the group the
+    dispatcher has taken off the queue but not started yet; beyond that, new
+    ones are rejected with `DispatcherBusy` instead of letting latency grow
+    without bound.
+    The dispatcher takes the first waiting request, collects whatever else
+    arrives within `batch_window` seconds (up to `concurrency` requests), and
+    starts the group together as slots free up, so the server's parallel
+    slots fill at once. Ollama has no multi-prompt endpoint, so a group is
+    sent as concurrent requests over the pooled keep-alive connections.
+
+    A caller waits at most `wait_timeout` seconds (queue wait plus
+    generation) before giving up with `DispatcherBusy`. `close` fails every
+    queued and running request with `DispatcherClosed`.
+    """
+
+    BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+    def __init__(self, base_url: str, model: str, options: dict, concurrency: int = 4,
+                 queue_size: int = 256, batch_window: float = 0.005, timeout: float = 30.0,
+                 wait_timeout: float = 120.0, prefix: str = "ollama"):
+        self.base_url = base_url
+        self.model = model
+        self.options = options
+        self.concurrency = max(concurrency, 1)
+        self.queue_size = queue_size
+        self.batch_window = batch_window
+        self.timeout = timeout
+        self.wait_timeout = wait_timeout
+        self.prefix = prefix
+        self.wait_time = Histogram(f"{prefix}_queue_wait_seconds",
+                                   "Time a generation request waited for a free slot.")
+        self.generate_time = Histogram(f"{prefix}_generate_seconds",
+                                       "Time of one generation request to the model server, by outcome.",
+                                       ("outcome",))
+        self.batch_size = Histogram(f"{prefix}_batch_size", "Requests started together per batching window.",
+                                    buckets=self.BATCH_BUCKETS)
+        self.rejected = 0
+        self.in_flight = 0
+        self._held = 0  # taken off the queue by `_dispatch`, still waiting for a slot
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._dispatch_task: Optional[asyncio.Task] = None
+        self._tasks: set[asyncio.Task] = set()  # running generations; the loop only keeps weak references
+        self._closed = False
+        self._start_lock = threading.Lock()
+
+    def generate(self, prompt: str) -> str:
+        """Generate a completion for `prompt`; blocks the calling thread until it is done.
+
+        Raises `DispatcherBusy` when the queue is full or no result came
+        within `wait_timeout`, `DispatcherClosed` once the dispatcher is
+        closed, and httpx errors when the model server fails or times out.
+        """
+        loop = self._ensure_started()
+        future: Future = Future()
+        loop.call_soon_threadsafe(self._enqueue, prompt, future)
+        try:
+            text, waited = future.result(self.wait_timeout)
+        except FutureTimeout:
+            future.cancel()  # skipped if still queued; a running generation finishes unobserved
+            raise DispatcherBusy(f"No LLM result within {self.wait_timeout:g} s.") from None
+        timing = current_timing()
+        if timing is not None:
+            timing.add("llm_queue", waited)
+        return text
+
+    async def agenerate(self, prompt: str) -> str:
+        """`generate` for coroutines on another event loop; raises the same errors.
+
+        Giving up (after `wait_timeout`, or when the awaiting task is
+        cancelled) cancels the request like `generate` does.
+        """
+        loop = self._ensure_started()
+        future: Future = Future()
+        loop.call_soon_threadsafe(self._enqueue, prompt, future)
+        try:
+            text, waited = await asyncio.wait_for(asyncio.wrap_future(future), self.wait_timeout)
+        except asyncio.TimeoutError:
+            raise DispatcherBusy(f"No LLM result within {self.wait_timeout:g} s.") from None
+        timing = current_timing()
+        if timing is not None:
+            timing.add("llm_queue", waited)
+        return text
+
+    def _ensure_started(self) -> asyncio.AbstractEventLoop:
+        with self._start_lock:
+            if self._closed:
+                raise DispatcherClosed("LLM dispatcher is closed.")
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="ollama-dispatcher", daemon=True).start()
+                asyncio.run_coroutine_threadsafe(self._setup(), loop).result()
+                self._loop = loop
+            return self._loop
+
+    async def _setup(self) -> None:
+        self._queue = asyncio.Queue(self.queue_size)
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency),
+        )
+        self._dispatch_task = asyncio.create_task(self._dispatch())
+
+    @staticmethod
+    def _settle(future: Future, result=None, exc: Optional[BaseException] = None) -> None:
+        """Complete `future` unless its caller already gave up on it."""
+        try:
+            if exc is not None:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+        except InvalidStateError:
+            pass  # cancelled after `wait_timeout`
+
+    def _enqueue(self, prompt: str, future: Future) -> None:
+        if self._closed:
+            self._settle(future, exc=DispatcherClosed("LLM dispatcher is closed."))
+            return
+        if self._queue.qsize() + self._held >= self.queue_size:
+            self.rejected += 1
+            self._settle(future, exc=DispatcherBusy(f"LLM queue is full ({self.queue_size} requests waiting)."))
+            return
+        self._queue.put_nowait((prompt, future, time.perf_counter()))
+
+    async def _dispatch(self) -> None:
+        loop = asyncio.get_running_loop()
+        batch = []
+        try:
+            while True:
+                batch = [await self._queue.get()]
+                self._held = 1
+                deadline = loop.time() + self.batch_window
+                while len(batch) < self.concurrency:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                        self._held += 1
+                    except asyncio.TimeoutError:
+                        break
+                self.batch_size.observe(len(batch))
+                while batch:
+                    prompt, future, enqueued = batch[0]
+                    if not future.cancelled():  # the caller stopped waiting
+                        await self._slots.acquire()
+                        task = asyncio.create_task(self._run(prompt, future, enqueued))
+                        self._tasks.add(task)
+                        task.add_done_callback(self._tasks.discard)
+                    batch.pop(0)
+                    self._held -= 1
+        except asyncio.CancelledError:
+            for _, future, _ in batch:
+                self._settle(future, exc=DispatcherClosed("LLM dispatcher is closed."))
+            raise
+
+    async def _run(self, prompt: str, future: Future, enqueued: float) -> None:
+        started = time.perf_counter()
+        waited = started - enqueued
+        self.wait_time.observe(waited)
+        self.in_flight += 1
+        outcome = "error"
+        try:
+            response = await self._client.post("/api/generate", json={
+                "model": self.model,
+                "prompt": prompt,
+                "stream": False,
+                "options": self.options,
+            })
+            response.raise_for_status()
+            text = response.json()["response"]
+            outcome = "ok"
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            self._settle(future, exc=DispatcherClosed("LLM dispatcher closed during the generation."))
+            raise
+        except Exception as exc:
+            self._settle(future, exc=exc)
+        else:
+            self._settle(future, (text, waited))
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+            self.generate_time.observe(time.perf_counter() - started, outcome)
+
+    def close(self) -> None:
+        """Stop taking requests, fail the queued and running ones with `DispatcherClosed`,
+        then stop the dispatcher thread and close the HTTP client pool."""
+        with self._start_lock:
+            self._closed = True
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+
+        async def shutdown():
+            tasks = [self._dispatch_task, *self._tasks]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            while not self._queue.empty():
+                _, future, _ = self._queue.get_nowait()
+                self._settle(future, exc=DispatcherClosed("LLM dispatcher is closed."))
+            await self._client.aclose()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+
+    def collect(self) -> list[str]:
+        queued = self._queue.qsize() + self._held if self._queue is not None else 0
+        return (
+            format_metric(f"{self.prefix}_queue_depth", "gauge", "Generation requests waiting for a slot.",
+                          [({}, queued)])
+            + format_metric(f"{self.prefix}_in_flight", "gauge", "Generation requests running on the model server.",
+                            [({}, self.in_flight)])
+            + format_metric(f"{self.prefix}_rejected_total", "counter", "Requests rejected because the queue was full.",
+                            [({}, self.rejected)])
+            + self.wait_time.collect()
+            + self.generate_time.collect()
+            + self.batch_size.collect()
+        )
@@ -6,16 +6,43 @@ FastAPI endpoint for classifying email content into threat request categories.
 
 from __future__ import annotations
 
+import os
 import re
 import html
-from typing import Optional
-from dataclasses import dataclass, field
-
-from fastapi import FastAPI, HTTPException
+import codecs
+import json
+import hashlib
+import threading
+import time
+import multiprocessing
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from itertools import accumulate
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from types import MappingProxyType
+from typing import AsyncIterator, Iterable, Optional
+from dataclasses import asdict, dataclass, field
+
+import numpy as np
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, ValidationError
+from starlette.requests import ClientDisconnect
 import uvicorn
 
+try:
+    import re2  # optional (google-re2): linear-time matching for rule regexes
+except ImportError:
+    re2 = None
+
+from metrics import (CONTENT_TYPE as METRICS_CONTENT_TYPE, Registry, RequestTiming, current_timing,
+                     format_metric, instrument_app)
+
 
 # ---------------------------------------------------------------------------
 # Rule Engine
@@ -414,108 +441,1708 @@ RULES: dict[str, CategoryRule] = {
 }
 
 
+# ---------------------------------------------------------------------------
+# Phrase Matcher
+# ---------------------------------------------------------------------------
+
+class PhraseAutomaton:
+    """Aho-Corasick automaton that finds every occurrence of every phrase in one pass."""
+
+    def __init__(self, phrases: list[str]):
+        self.phrases = phrases
+        goto: list[dict[str, int]] = [{}]
+        out: list[tuple[int, ...]] = [()]
+
+        # Build the trie
+        for phrase_id, phrase in enumerate(phrases):
+            state = 0
+            for ch in phrase:
+                nxt = goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto.append({})
+                    out.append(())
+                    goto[state][ch] = nxt
+                state = nxt
+            out[state] += (phrase_id,)
+
+        # Breadth-first pass: failure links, inherited outputs and the full
+        # transition table (so scanning never has to walk failure links).
+        fail = [0] * len(goto)
+        delta: list[dict[str, int]] = [dict(goto[0])] + [{}] * (len(goto) - 1)
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            delta[state] = {**delta[fail[state]], **goto[state]}
+            for ch, nxt in goto[state].items():
+                fail[nxt] = delta[fail[state]].get(ch, 0) if state else 0
+                out[nxt] += out[fail[nxt]]
+                queue.append(nxt)
+
+        self._delta = delta
+        self._out = out
+
+    def scan(self, text: str) -> dict[int, list[int]]:
+        """Return {phrase_id: [start offsets]} for every phrase found in `text`."""
+        return self.scan_from(text)[0]
+
+    def scan_from(self, text: str, state: Optional[int] = None, offset: int = 0,
+                  final: bool = False) -> tuple[dict[int, list[int]], int]:
+        """Continue a scan over the next piece of a text that arrives in chunks.
+
+        `state` is what the previous call returned (None for the first piece)
+        and `offset` the length of the text scanned before; phrases cut by
+        the chunk boundary are found when their last character arrives.
+        Returns (hits, state) with hit offsets relative to the whole text.
+        """
+        delta = self._delta
+        out = self._out
+        phrases = self.phrases
+        hits: dict[int, list[int]] = {}
+        state = state or 0
+        base = offset + 1
+        for i, ch in enumerate(text, base):
+            state = delta[state].get(ch, 0)
+            if out[state]:
+                for phrase_id in out[state]:
+                    hits.setdefault(phrase_id, []).append(i - len(phrases[phrase_id]))
+        return hits, state
+
+
+# Everything but word characters and ' . - separates words ("sign-in",
+# "bit.ly" and "don't" are one word each). One character in, one out, so
+# offsets are kept.
+_WORD_SEPARATOR_RE = re.compile(r"[^\w'.\- ]")
+_WORD_EDGES = "'.-"
+
+
+def split_words(text: str) -> tuple[list[str], list[str]]:
+    """Split `text` on single separator characters; returns (raw pieces, words).
+
+    Piece `i` starts at offset sum(len(piece) + 1 for the pieces before it);
+    words are the pieces with ' . - stripped from both ends. Empty words
+    mark runs of separators, so punctuation between two words breaks a phrase.
+    """
+    raw = _WORD_SEPARATOR_RE.sub(" ", text).split(" ")
+    return raw, [piece.strip(_WORD_EDGES) for piece in raw]
+
+
+class NgramMatcher:
+    """Word-level phrase matcher over a precomputed table of phrase n-grams.
+
+    Phrases and text are split into words the same way (`split_words`), so a
+    phrase only matches on word boundaries: "wire" does not fire inside
+    "wireless". The one inflection allowed is a plural "s" on the last word
+    ("gift card" matches "gift cards"). The table is nested by word: looking up an n-gram extends
+    the (n-1)-gram found at the same start and stops as soon as no phrase
+    continues that way, so a scan is linear in the number of words for
+    phrases of at most `max_tokens` words. In practice it is no faster than
+    `PhraseAutomaton` (compare them with benchmark.py), so choose it for
+    whole-word matching, not for speed. Same `scan` interface as
+    `PhraseAutomaton`.
+    """
+
+    def __init__(self, phrases: list[str]):
+        self.phrases = phrases
+        self.max_tokens = 0
+        # word -> (ids of phrases ending with this word, continuations)
+        self._table: dict[str, tuple[list[int], dict]] = {}
+        for phrase_id, phrase in enumerate(phrases):
+            words = [word for word in split_words(phrase)[1] if word]
+            if not words:
+                continue  # punctuation only: can never match a word
+            variants = [words]
+            if words[-1][-1].isalpha() and not words[-1].endswith("s"):
+                variants.append(words[:-1] + [words[-1] + "s"])  # "gift card" also matches "gift cards"
+            for variant in variants:
+                level = self._table
+                for word in variant:
+                    node = level.setdefault(word, ([], {}))
+                    level = node[1]
+                node[0].append(phrase_id)
+            self.max_tokens = max(self.max_tokens, len(words))
+
+    def scan(self, text: str) -> dict[int, list[int]]:
+        """Return {phrase_id: [start offsets]} for every phrase found in `text`."""
+        return self.scan_from(text, final=True)[0]
+
+    def scan_from(self, text: str, state: Optional[tuple[str, int]] = None, offset: int = 0,
+                  final: bool = False) -> tuple[dict[int, list[int]], Optional[tuple[str, int]]]:
+        """Continue a scan over the next piece of a text that arrives in chunks.
+
+        Same contract as `PhraseAutomaton.scan_from`. Until `final`, the last
+        `max_tokens` words are not matched yet but carried over in `state`
+        (the last one may be cut), and scanned again with the next piece.
+        """
+        if state is not None:
+            carry, offset = state
+            text = carry + text
+        raw, words = split_words(text)
+        n_words = len(words)
+        limit = n_words if final else max(n_words - max(self.max_tokens, 1), 0)
+        table = self._table
+        hits: dict[int, list[int]] = {}  # phrase id -> word indexes, turned into offsets at the end
+        for i, (phrase_ids, continuations) in [
+            (i, node) for i, node in enumerate(map(table.get, words if final else words[:limit]))
+            if node is not None
+        ]:
+            for phrase_id in phrase_ids:
+                hits.setdefault(phrase_id, []).append(i)
+            j = i + 1
+            while continuations and j < n_words:
+                node = continuations.get(words[j])
+                if node is None:
+                    break
+                phrase_ids, continuations = node
+                for phrase_id in phrase_ids:
+                    hits.setdefault(phrase_id, []).append(i)
+                j += 1
+        if hits or not final:
+            offsets = list(accumulate((len(piece) + 1 for piece in raw), initial=offset))
+            for phrase_id, indexes in hits.items():
+                hits[phrase_id] = [offsets[i] + len(raw[i]) - len(raw[i].lstrip(_WORD_EDGES)) for i in indexes]
+        if final:
+            return hits, None
+        carried = offsets[limit] - offset
+        return hits, (text[carried:], offsets[limit])
+
+
+MATCHERS = {"substring": PhraseAutomaton, "ngram": NgramMatcher}
+DEFAULT_MATCHER = os.environ.get("MAILARMOR_MATCHER", "substring")
+
+
+@dataclass(frozen=True)
+class PhraseEntry:
+    category: str
+    tier: str       # "primary" | "supporting" | "negative"
+    phrase: str
+    weight: int
+    phrase_id: int = -1
+
+
+@dataclass(frozen=True)
+class RegexEntry:
+    category: str
+    source: str
+    pattern: re.Pattern
+    weight: int
+    linear: bool = False  # compiled with re2: no catastrophic backtracking
+
+
+REGEX_ENGINE = os.environ.get("MAILARMOR_REGEX_ENGINE", "auto")  # "auto" (re2 when installed) | "re"
+
+
+def compile_regex(source: str) -> tuple[re.Pattern, bool]:
+    """Compile a rule regex; returns (pattern, linear).
+
+    With re2 installed, patterns it supports are compiled as linear-time
+    automata. Patterns using lookaround or backreferences stay on the
+    backtracking `re` engine and are guarded by `RegexBudget` instead.
+    """
+    if re2 is not None and REGEX_ENGINE != "re":
+        try:
+            return re2.compile(source), True
+        except re2.error:
+            pass
+    return re.compile(source), False
+
+
+class CompiledRules:
+    """A rule set compiled into a single phrase matcher plus precompiled regexes.
+
+    `matcher` picks how phrases are found: "substring" (`PhraseAutomaton`,
+    phrases match anywhere) or "ngram" (`NgramMatcher`, whole words only).
+
+    Every (phrase, weight) tuple of every category becomes a `PhraseEntry`,
+    numbered in rule order so that hits can be reported in the same order the
+    rules are written in. Regex patterns are compiled here, once, so the hot
+    path never goes through the `re` module cache.
+
+    Phrase entries followed by regex entries form the rule *features*: feature
+    `i < len(entries)` is `entries[i]`, the rest are `regexes[i - len(entries)]`.
+    `feature_category_ids` and `feature_weights` hold `feature_category` and
+    `feature_weight` as NumPy arrays for batch scoring.
+
+    Instances are never modified after construction; a rule change builds a
+    new one (see `reload_rules`). `version` is a hash of the rule content.
+
+    `regex_gain` (per category, the most its regexes can add) and
+    `prune_thresholds` support score upper-bound pruning in `match_features`;
+    `negative_weight` (per category, the sum of its negative feature
+    weights) bounds early decisions in `ClassificationSession`.
+    `feature_keys` names each feature as (category, tier, phrase or pattern)
+    for the profiling counters.
+    """
+
+    def __init__(self, rules: dict[str, CategoryRule], matcher: str = DEFAULT_MATCHER):
+        if matcher not in MATCHERS:
+            raise ValueError(f"Unknown matcher {matcher!r}; expected one of {sorted(MATCHERS)}.")
+        self.rules = MappingProxyType(dict(rules))
+        self.matcher = matcher
+        content = rules_to_dict(rules)
+        if matcher != "substring":  # keeps the versions of existing substring rulesets unchanged
+            content = {"matcher": matcher, "categories": content}
+        self.version = hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()[:12]
+        self.compiled_at = datetime.now(timezone.utc)
+        self.entries: list[PhraseEntry] = []
+        for category, rule in rules.items():
+            for tier, phrases in (("primary", rule.primary),
+                                  ("supporting", rule.supporting),
+                                  ("negative", rule.negative)):
+                for phrase, weight in phrases:
+                    self.entries.append(PhraseEntry(category, tier, phrase, weight))
+
+        phrase_ids: dict[str, int] = {}
+        phrase_entries: list[list[int]] = []
+        for entry_id, entry in enumerate(self.entries):
+            phrase_id = phrase_ids.setdefault(entry.phrase, len(phrase_ids))
+            if phrase_id == len(phrase_entries):
+                phrase_entries.append([])
+            phrase_entries[phrase_id].append(entry_id)
+            self.entries[entry_id] = PhraseEntry(entry.category, entry.tier, entry.phrase,
+                                                 entry.weight, phrase_id)
+
+        self.phrase_entries = [tuple(ids) for ids in phrase_entries]
+        self.automaton = MATCHERS[matcher](list(phrase_ids))
+        # Most whitespace tokens (or matcher words) one phrase hit can span
+        self.max_phrase_tokens = max((max(len(phrase.split()), len(split_words(phrase)[1]))
+                                      for phrase in phrase_ids), default=0)
+
+        self.regexes: list[RegexEntry] = []
+        for category, rule in rules.items():
+            for pattern, weight in rule.regex_patterns:
+                compiled, linear = compile_regex(pattern)
+                self.regexes.append(RegexEntry(category, pattern, compiled, weight, linear))
+
+        self.categories = list(rules)
+        category_ids = {category: i for i, category in enumerate(self.categories)}
+        self.category_thresholds = [rule.threshold for rule in rules.values()]
+        self.thresholds = np.array(self.category_thresholds, dtype=np.int64)
+        self.regex_gain = [sum(max(weight, 0) for _, weight in rule.regex_patterns) for rule in rules.values()]
+        # A category with threshold <= 0 qualifies even with no hits, so it is never pruned
+        self.prune_thresholds = [rule.threshold if rule.threshold > 0 else float("-inf")
+                                 for rule in rules.values()]
+
+        features: list[tuple[str, int, str]] = []
+        for entry in self.entries:
+            if entry.tier == "primary":
+                label = f"[primary] {entry.phrase!r}"
+            elif entry.tier == "supporting":
+                label = f"[support] {entry.phrase!r}"
+            else:
+                label = f"[negative] {entry.phrase!r} ({entry.weight})"
+            features.append((entry.category, entry.weight, label))
+        for regex in self.regexes:
+            features.append((regex.category, regex.weight, f"[regex] {regex.source!r}"))
+
+        self.feature_category = [category_ids[category] for category, _, _ in features]
+        self.feature_weight = [weight for _, weight, _ in features]
+        self.feature_labels = [label for _, _, label in features]
+        self.feature_keys = [(entry.category, entry.tier, entry.phrase) for entry in self.entries]
+        self.feature_keys += [(regex.category, "regex", regex.source) for regex in self.regexes]
+        self.feature_category_ids = np.array(self.feature_category, dtype=np.intp)
+        self.feature_weights = np.array(self.feature_weight, dtype=np.int64)
+        self.negative_weight = [0] * len(self.categories)
+        for category, weight in zip(self.feature_category, self.feature_weight):
+            if weight < 0:
+                self.negative_weight[category] += weight
+
+    def match(self, text: str) -> tuple[list[int], dict[int, list[int]]]:
+        """Scan `text` once.
+
+        Returns the matched entry ids in rule order, plus the start offsets of
+        each matched phrase keyed by phrase id.
+        """
+        occurrences = self.automaton.scan(text)
+        entry_ids = sorted(
+            entry_id
+            for phrase_id in occurrences
+            for entry_id in self.phrase_entries[phrase_id]
+        )
+        return entry_ids, occurrences
+
+
+# ---------------------------------------------------------------------------
+# Rule Loading
+# ---------------------------------------------------------------------------
+
+RULES_FILE = os.environ.get("MAILARMOR_RULES_FILE")
+RULES_WATCH_INTERVAL = float(os.environ.get("MAILARMOR_RULES_WATCH_INTERVAL", "0"))  # seconds, 0 = off
+
+
+def rules_to_dict(rules: dict[str, CategoryRule]) -> dict:
+    """Serialize rules to the JSON layout read by `load_rules_file`."""
+    return {category: asdict(rule) for category, rule in rules.items()}
+
+
+def rules_from_dict(data: dict) -> dict[str, CategoryRule]:
+    """Build rules from the JSON layout:
+
+        {"<category>": {"primary": [["phrase", 10], ...], "supporting": [...],
+                        "negative": [...], "threshold": 10, "regex_patterns": [...]}}
+    """
+    if not isinstance(data, dict) or not data:
+        raise ValueError("Rules must be a non-empty object keyed by category.")
+    rules: dict[str, CategoryRule] = {}
+    for category, spec in data.items():
+        try:
+            rules[category] = CategoryRule(
+                primary=[(str(p), int(w)) for p, w in spec.get("primary", [])],
+                supporting=[(str(p), int(w)) for p, w in spec.get("supporting", [])],
+                negative=[(str(p), int(w)) for p, w in spec.get("negative", [])],
+                threshold=int(spec["threshold"]),
+                regex_patterns=[(str(p), int(w)) for p, w in spec.get("regex_patterns", [])],
+            )
+            for pattern, _ in rules[category].regex_patterns:
+                re.compile(pattern)
+        except (AttributeError, KeyError, TypeError, ValueError, re.error) as exc:
+            raise ValueError(f"Invalid rule for category {category!r}: {exc!r}") from exc
+    return rules
+
+
+def ruleset_from_dict(data: dict) -> tuple[dict[str, CategoryRule], str]:
+    """Build (rules, matcher) from either the plain per-category layout (see
+    `rules_from_dict`; uses `DEFAULT_MATCHER`) or a ruleset that picks its
+    phrase matcher:
+
+        {"matcher": "ngram", "categories": {"<category>": {...}, ...}}
+    """
+    if isinstance(data, dict) and isinstance(data.get("categories"), dict) and "threshold" not in data["categories"]:
+        matcher = data.get("matcher", DEFAULT_MATCHER)
+        if matcher not in MATCHERS:
+            raise ValueError(f"Unknown matcher {matcher!r}; expected one of {sorted(MATCHERS)}.")
+        return rules_from_dict(data["categories"]), matcher
+    return rules_from_dict(data), DEFAULT_MATCHER
+
+
+def load_rules_file(path: str) -> tuple[dict[str, CategoryRule], str]:
+    with open(path, encoding="utf-8") as f:
+        return ruleset_from_dict(json.load(f))
+
+
+_active_rules = CompiledRules(*load_rules_file(RULES_FILE)) if RULES_FILE else CompiledRules(RULES)
+_reload_lock = threading.Lock()
+
+
+def get_active_rules() -> CompiledRules:
+    """Return the ruleset new classifications should use.
+
+    Callers take it once per request and keep using that object, so a reload
+    never changes the rules under a classification that is already running.
+    """
+    return _active_rules
+
+
+def reload_rules(path: Optional[str] = RULES_FILE) -> CompiledRules:
+    """Compile the rules in `path` (built-in RULES if None) and swap them in.
+
+    Compilation happens before the swap; on any error the active ruleset is
+    left untouched and the exception propagates.
+    """
+    global _active_rules
+    with _reload_lock:
+        compiled = CompiledRules(*load_rules_file(path)) if path else CompiledRules(RULES)
+        _active_rules = compiled
+    return compiled
+
+
+class RulesFileWatcher(threading.Thread):
+    """Polls a rules file and reloads it when its modification time changes."""
+
+    def __init__(self, path: str, interval: float):
+        super().__init__(name="rules-file-watcher", daemon=True)
+        self.path = path
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._mtime = self._read_mtime()
+
+    def _read_mtime(self) -> Optional[float]:
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            mtime = self._read_mtime()
+            if mtime is None or mtime == self._mtime:
+                continue
+            self._mtime = mtime
+            try:
+                compiled = reload_rules(self.path)
+                print(f"Rules reloaded from {self.path}: version {compiled.version}")
+            except (OSError, ValueError) as exc:
+                print(f"Rules reload from {self.path} failed, keeping {get_active_rules().version}: {exc}")
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+
+# ---------------------------------------------------------------------------
+# Tenant Rule Overlays
+# ---------------------------------------------------------------------------
+
+TENANT_RULES_DIR = os.environ.get("MAILARMOR_TENANT_RULES_DIR")  # holds <tenant_id>.json overlays
+TENANT_CACHE_SIZE = int(os.environ.get("MAILARMOR_TENANT_CACHE_SIZE", "256"))  # compiled tenant rulesets
+_TENANT_ID_RE = re.compile(r"[A-Za-z0-9_-]{1,128}")  # also keeps ids from leaving TENANT_RULES_DIR
+_OVERLAY_KEYS = {"disabled_categories", "thresholds", "weights", "extra_phrases"}
+_OVERLAY_TIERS = ("primary", "supporting", "negative", "regex_patterns")
+
+
+def apply_overlay(rules: dict[str, CategoryRule], overlay: dict) -> dict[str, CategoryRule]:
+    """Merge a tenant overlay onto base rules and return the tenant's rules:
+
+        {"disabled_categories": ["meeting_request"],
+         "thresholds": {"invoice_payment": 12},
+         "weights": {"wire_transfer": {"wire transfer": 15}},
+         "extra_phrases": {"invoice_payment": {"primary": [["remittance advice", 8]]}}}
+
+    `weights` overrides the weight of an existing phrase or regex pattern of
+    the category, in every tier it appears in; `extra_phrases` adds entries
+    per tier (primary, supporting, negative, regex_patterns). Disabled
+    categories are left out of the result, so they cost nothing to match.
+    """
+    if not isinstance(overlay, dict) or not set(overlay) <= _OVERLAY_KEYS:
+        raise ValueError(f"Overlay must be an object with keys from {sorted(_OVERLAY_KEYS)}.")
+    try:
+        disabled = {str(category) for category in overlay.get("disabled_categories", [])}
+        thresholds = dict(overlay.get("thresholds", {}))
+        weights = dict(overlay.get("weights", {}))
+        extra_phrases = dict(overlay.get("extra_phrases", {}))
+        unknown = (disabled | set(thresholds) | set(weights) | set(extra_phrases)) - set(rules)
+        if unknown:
+            raise ValueError(f"Unknown categories {sorted(unknown)}.")
+
+        merged: dict[str, CategoryRule] = {}
+        for category, rule in rules.items():
+            if category in disabled:
+                continue
+            overrides = {str(phrase): int(weight) for phrase, weight in weights.get(category, {}).items()}
+            extra = extra_phrases.get(category, {})
+            if not set(extra) <= set(_OVERLAY_TIERS):
+                raise ValueError(f"Unknown tiers {sorted(set(extra) - set(_OVERLAY_TIERS))}.")
+            tiers: dict[str, list[tuple[str, int]]] = {}
+            for tier in _OVERLAY_TIERS:
+                tiers[tier] = [(phrase, overrides.get(phrase, weight)) for phrase, weight in getattr(rule, tier)]
+                tiers[tier] += [(str(phrase), int(weight)) for phrase, weight in extra.get(tier, [])]
+            missing = set(overrides) - {phrase for entries in tiers.values() for phrase, _ in entries}
+            if missing:
+                raise ValueError(f"No phrases {sorted(missing)} to reweight in {category!r}.")
+            for pattern, _ in tiers["regex_patterns"]:
+                re.compile(pattern)
+            merged[category] = CategoryRule(threshold=int(thresholds.get(category, rule.threshold)), **tiers)
+    except (AttributeError, KeyError, TypeError, ValueError, re.error) as exc:
+        raise ValueError(f"Invalid rules overlay: {exc}") from exc
+    if not merged:
+        raise ValueError("Invalid rules overlay: every category is disabled.")
+    return merged
+
+
+class TenantRulesCache:
+    """Compiled rulesets of tenants with an overlay, least recently used evicted first.
+
+    A tenant's ruleset is the active base ruleset with `<tenant_id>.json` from
+    `directory` applied (`apply_overlay`). It is compiled on first use and
+    reused while neither the base version nor the overlay file's modification
+    time changes, so only the first request after a change pays the compile
+    cost. Tenants without an overlay file get the base ruleset itself.
+    """
+
+    def __init__(self, directory: Optional[str], max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+        self._data: OrderedDict[str, tuple[str, int, CompiledRules]] = OrderedDict()  # base version, mtime
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, tenant_id: Optional[str]) -> CompiledRules:
+        """The ruleset for `tenant_id` (the base ruleset for None). Raises ValueError
+        for a malformed tenant id or an invalid overlay file."""
+        base = get_active_rules()
+        if not tenant_id or self.directory is None:
+            return base
+        if not _TENANT_ID_RE.fullmatch(tenant_id):
+            raise ValueError(f"Invalid tenant id {tenant_id!r}.")
+        path = os.path.join(self.directory, f"{tenant_id}.json")
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return base
+
+        with self._lock:
+            item = self._data.get(tenant_id)
+            if item is not None and item[0] == base.version and item[1] == mtime:
+                self._data.move_to_end(tenant_id)
+                self.hits += 1
+                return item[2]
+            self.misses += 1
+
+        try:
+            with open(path, encoding="utf-8") as f:
+                overlay = json.load(f)
+            compiled = CompiledRules(apply_overlay(dict(base.rules), overlay), base.matcher)
+        except (OSError, ValueError) as exc:
+            raise ValueError(f"Rules overlay for tenant {tenant_id!r} failed to load: {exc}") from exc
+        if self.max_size > 0:
+            with self._lock:
+                self._data[tenant_id] = (base.version, mtime, compiled)
+                self._data.move_to_end(tenant_id)
+                while len(self._data) > self.max_size:
+                    self._data.popitem(last=False)
+                    self.evictions += 1
+        return compiled
+
+    def by_version(self, version: str) -> Optional[CompiledRules]:
+        """A cached tenant ruleset with this version, if any (for `/explain`)."""
+        with self._lock:
+            return next((rules for _, _, rules in self._data.values() if rules.version == version), None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+TENANT_RULES = TenantRulesCache(TENANT_RULES_DIR, TENANT_CACHE_SIZE)
+
+
 # ---------------------------------------------------------------------------
 # Preprocessing
 # ---------------------------------------------------------------------------
 
+# A "<" with no ">" within this many characters is text, not a tag
+HTML_MAX_TAG_CHARS = max(int(os.environ.get("MAILARMOR_HTML_MAX_TAG_CHARS", str(64 * 1024))), 16)
+_HIDDEN_START_RE = re.compile(r"<!--|<(script|style)\b", re.I)
+_HIDDEN_END_RE = {
+    "--": re.compile(r"-->"),
+    "script": re.compile(r"</script[^>]*>", re.I),
+    "style": re.compile(r"</style[^>]*>", re.I),
+}
+
+
+def _strip_tags(text: str) -> str:
+    """Replace every tag in `text` with a space, in one pass.
+
+    A tag is "<" plus a letter (or "/" and a letter, or "!" or "?") up to the
+    next ">", at most `HTML_MAX_TAG_CHARS` characters later. The next ">" is
+    only looked up again once the scan has passed it, so a run of unclosed
+    "<" costs no more than ordinary text.
+    """
+    lt = text.find("<")
+    if lt == -1:
+        return text
+    out: list[str] = []
+    pos = 0
+    gt = -1
+    while lt != -1:
+        if gt < lt:
+            gt = text.find(">", lt)
+            if gt == -1:
+                break  # no ">" left: nothing further can be a tag
+        mark = text[lt + 1:lt + 2]
+        if mark == "!" or mark == "?":
+            body = lt + 2
+        else:
+            name = lt + 2 if mark == "/" else lt + 1
+            letter = text[name:name + 1]
+            body = name + 1 if letter.isascii() and letter.isalpha() else -1
+        if body != -1 and gt - body <= HTML_MAX_TAG_CHARS:
+            out.append(text[pos:lt])
+            out.append(" ")
+            pos = gt + 1
+            lt = text.find("<", pos)
+        else:
+            lt = text.find("<", lt + 1)
+    out.append(text[pos:])
+    return "".join(out)
+
+
+class HtmlTextStream:
+    """Incremental HTML-to-text converter.
+
+    Feed it the raw email in one or more chunks; each call returns the visible
+    text decoded so far — tags removed, entities unescaped, whitespace
+    collapsed, lowercased. Comments and the content of <script>/<style>
+    elements are dropped. A tag or entity cut off at the end of a chunk is
+    held back until the next one; a tag longer than `HTML_MAX_TAG_CHARS` is
+    not a tag, so at most that much is ever held back.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._hidden_tag: Optional[str] = None  # script/style whose opening tag is still open
+        self._hidden_end: Optional[re.Pattern] = None  # end of the comment/element being skipped
+        self._started = False   # any word emitted yet
+        self._space = False     # whitespace (or a tag) since the last emitted word
+
+    def feed(self, chunk: str) -> str:
+        return self._drain(self._buffer + chunk, final=False)
+
+    def close(self) -> str:
+        return self._drain(self._buffer, final=True)
+
+    def _drain(self, buf: str, final: bool) -> str:
+        out: list[str] = []
+        pos, n = 0, len(buf)
+        while pos < n:
+            if self._hidden_tag is not None:
+                gt = buf.find(">", pos)
+                if gt == -1:
+                    pos = n  # still inside the opening tag
+                    break
+                pos = gt + 1
+                self._hidden_end = _HIDDEN_END_RE[self._hidden_tag]
+                self._hidden_tag = None
+                continue
+
+            if self._hidden_end is not None:
+                end = self._hidden_end.search(buf, pos)
+                if end is None:
+                    # Keep a possible partial end marker for the next chunk
+                    pos = n if final else max(pos, n - 16)
+                    break
+                self._hidden_end = None
+                self._space = True
+                pos = end.end()
+                continue
+
+            hidden = _HIDDEN_START_RE.search(buf, pos)
+            if hidden and hidden.end() == n and not final:
+                hidden = None  # "<script" might go on as "<scripts>": a possible partial tag
+            end = hidden.start() if hidden else n
+            if hidden is None and not final:
+                text_start = max(pos, buf.rfind(">", pos) + 1)  # "&" before a ">" may be inside a tag
+                lt = buf.find("<", max(text_start, n - HTML_MAX_TAG_CHARS - 3))
+                if lt != -1:
+                    end = lt  # possibly a partial tag
+                amp = buf.rfind("&", max(text_start, end - 32), end)
+                if amp != -1 and ";" not in buf[amp:end]:
+                    end = amp  # possibly a partial entity
+            if end > pos:
+                self._emit_text(_strip_tags(buf[pos:end]), out)
+            pos = end
+            if hidden is None:
+                break
+
+            name = hidden.group(1)
+            if name is None:
+                pos = hidden.end()
+                self._hidden_end = _HIDDEN_END_RE["--"]
+                continue
+            pos = hidden.end()
+            self._hidden_tag = name.lower()
+
+        self._buffer = buf[pos:]
+        return "".join(out)
+
+    def _emit_text(self, text: str, out: list[str]) -> None:
+        if "&" in text:
+            text = html.unescape(text)
+        words = text.lower().split()
+        if not words:
+            self._space = self._space or bool(text)
+            return
+        if self._started and (self._space or text[0].isspace()):
+            out.append(" ")
+        out.append(" ".join(words))
+        self._started = True
+        self._space = text[-1].isspace()
+
+
 def preprocess(text: str) -> str:
-    """Strip HTML, normalize whitespace, lowercase."""
-    # Unescape HTML entities
-    text = html.unescape(text)
-    # Remove HTML tags
-    text = re.sub(r"<[^>]+>", " ", text)
-    # Collapse whitespace
-    text = re.sub(r"\s+", " ", text).strip()
-    return text.lower()
-
-
-def has_negation_before(text: str, phrase: str, window: int = 6) -> bool:
-    """Return True if a negation word appears within `window` words before `phrase`."""
-    negation_words = {"not", "no", "never", "don't", "do not", "cannot", "can't", "didn't"}
-    pattern = re.compile(re.escape(phrase))
-    for match in pattern.finditer(text):
-        start = match.start()
-        preceding = text[:start].split()[-window:]
-        if any(neg in " ".join(preceding) for neg in negation_words):
-            return True
-    return False
+    """Strip HTML (dropping script/style content), decode entities, normalize whitespace, lowercase."""
+    if "<" not in text and "&" not in text:
+        return " ".join(text.lower().split())
+    stream = HtmlTextStream()
+    return stream.feed(text) + stream.close()
+
+
+NEGATION_WINDOW = 6  # tokens before a primary phrase searched for a negation
+NEGATION_TOKENS = frozenset({"not", "no", "never", "don't", "cannot", "can't", "didn't"})
+_TOKEN_RE = re.compile(r"\S+")
+_TOKEN_PUNCT = ".,;:!?\"()[]{}<>*"
+
+
+class TokenIndex:
+    """Whitespace tokens of a document, indexed by character offset.
+
+    Built once per email so negation checks never re-tokenize the text.
+    `_negations[k]` is the number of negation tokens among the first k tokens.
+    """
+
+    def __init__(self, text: str):
+        self.starts: list[int] = []
+        self._negations: list[int] = [0]
+        count = 0
+        for match in _TOKEN_RE.finditer(text):
+            self.starts.append(match.start())
+            if match.group().strip(_TOKEN_PUNCT) in NEGATION_TOKENS:
+                count += 1
+            self._negations.append(count)
+
+    def has_negation_before(self, offset: int, window: int = NEGATION_WINDOW) -> bool:
+        """Return True if a negation token is among the `window` tokens before `offset`."""
+        k = bisect_left(self.starts, offset)
+        return self._negations[k] > self._negations[max(0, k - window)]
+
+
+def has_negation_before(index: TokenIndex, starts: list[int], window: int = NEGATION_WINDOW) -> bool:
+    """Return True if any occurrence of a phrase (given by its start offsets) is negated."""
+    return any(index.has_negation_before(start, window) for start in starts)
+
+
+# ---------------------------------------------------------------------------
+# Result Cache
+# ---------------------------------------------------------------------------
+
+CACHE_SIZE = int(os.environ.get("MAILARMOR_CACHE_SIZE", "10000"))   # entries, 0 = off
+CACHE_TTL = float(os.environ.get("MAILARMOR_CACHE_TTL", "300"))      # seconds
+
+
+CachedMatch = tuple[tuple[int, ...], bool]  # (matched feature ids, regex budget exceeded)
+
+
+class ResultCache:
+    """Bounded LRU cache of matched rule features with a TTL.
+
+    Keyed on (ruleset version, hash of the preprocessed text), so the same
+    campaign body sent to thousands of mailboxes is matched once, and a rules
+    reload never serves results computed with the old rules.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: OrderedDict[tuple[str, bool, bytes], tuple[float, CachedMatch]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0     # dropped to stay within max_size
+        self.expirations = 0   # dropped because the TTL passed
+
+    @staticmethod
+    def key(text: str, rules: CompiledRules, prune: bool = False) -> tuple[str, bool, bytes]:
+        digest = hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+        return rules.version, prune, digest
+
+    @staticmethod
+    def format_key(key: tuple[str, bool, bytes]) -> str:
+        version, prune, digest = key
+        return f"{version}.{int(prune)}.{digest.hex()}"
+
+    @staticmethod
+    def parse_key(result_id: str) -> tuple[str, bool, bytes]:
+        version, prune, digest = result_id.split(".")
+        if prune not in ("0", "1"):
+            raise ValueError(f"Invalid result id: {result_id!r}")
+        return version, prune == "1", bytes.fromhex(digest)
+
+    def peek(self, key: tuple[str, bool, bytes]) -> Optional[CachedMatch]:
+        """Like `get`, but leaves the counters and LRU order alone."""
+        with self._lock:
+            item = self._data.get(key)
+        if item is None or item[0] <= time.monotonic():
+            return None
+        return item[1]
+
+    def get(self, key: tuple[str, bool, bytes]) -> Optional[CachedMatch]:
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[0] <= now:
+                del self._data[key]
+                self.expirations += 1
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key: tuple[str, bool, bytes], match: CachedMatch) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, match)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+RESULT_CACHE = ResultCache(CACHE_SIZE, CACHE_TTL)
+
+
+# ---------------------------------------------------------------------------
+# Engine Profiling
+# ---------------------------------------------------------------------------
+
+PROFILE_ENGINE = os.environ.get("MAILARMOR_PROFILE", "0") == "1"
+
+
+class EngineProfile:
+    """Hot-path counters for the rule engine, exported on `/metrics`.
+
+    Label outcomes and regex budget overruns are always counted. With `enabled` (MAILARMOR_PROFILE=1),
+    each `match_features` run also records time per stage, per category (its
+    negation checks and regexes; the shared phrase scan is a stage of its
+    own) and per regex pattern, plus a hit count per rule feature. Counters
+    are keyed by names rather than feature ids, so they survive rule reloads.
+
+    Only texts actually matched in this process are profiled: result cache
+    hits and emails matched on the bulk process pool are counted as labels
+    but not timed.
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.labels: dict[str, int] = {}
+            self.budget_exceeded: dict[str, int] = {}
+            self.evaluations = 0
+            self.stage_ns: dict[str, int] = {}
+            self.category_ns: dict[str, int] = {}
+            self.regex_ns: dict[tuple[str, str], int] = {}
+            self.regex_evaluations: dict[tuple[str, str], int] = {}
+            self.rule_hits: dict[tuple[str, str, str], int] = {}
+
+    def record_labels(self, labels: Iterable[str]) -> None:
+        with self._lock:
+            for label in labels:
+                self.labels[label] = self.labels.get(label, 0) + 1
+
+    def record_budget_exceeded(self, reason: str) -> None:
+        with self._lock:
+            self.budget_exceeded[reason] = self.budget_exceeded.get(reason, 0) + 1
+
+    def record_stage(self, stage: str, elapsed_ns: int) -> None:
+        with self._lock:
+            self.stage_ns[stage] = self.stage_ns.get(stage, 0) + elapsed_ns
+
+    def record_evaluation(self, rules: CompiledRules, stage_ns: dict[str, int], category_ns: list[int],
+                          regex_ns: list[Optional[int]], features: list[int]) -> None:
+        """Add one `match_features` run; `regex_ns` is None for regexes skipped by pruning."""
+        with self._lock:
+            self.evaluations += 1
+            for stage, elapsed in stage_ns.items():
+                self.stage_ns[stage] = self.stage_ns.get(stage, 0) + elapsed
+            for category, elapsed in zip(rules.categories, category_ns):
+                self.category_ns[category] = self.category_ns.get(category, 0) + elapsed
+            for regex, elapsed in zip(rules.regexes, regex_ns):
+                if elapsed is not None:
+                    key = (regex.category, regex.source)
+                    self.regex_ns[key] = self.regex_ns.get(key, 0) + elapsed
+                    self.regex_evaluations[key] = self.regex_evaluations.get(key, 0) + 1
+            for feature_id in features:
+                key = rules.feature_keys[feature_id]
+                self.rule_hits[key] = self.rule_hits.get(key, 0) + 1
+
+    def collect(self, rules: CompiledRules) -> list[str]:
+        """Prometheus text lines. Rules of `rules` that never fired are reported with 0 hits."""
+        with self._lock:
+            labels = dict(self.labels)
+            budget_exceeded = dict(self.budget_exceeded)
+            evaluations = self.evaluations
+            stage_ns = dict(self.stage_ns)
+            category_ns = dict(self.category_ns)
+            regex_ns = dict(self.regex_ns)
+            regex_evaluations = dict(self.regex_evaluations)
+            rule_hits = dict(self.rule_hits)
+
+        lines = format_metric(
+            "mailarmor_classifications_total", "counter", "Emails classified, by winning label.",
+            (({"label": label}, count) for label, count in sorted(labels.items())))
+        lines += format_metric(
+            "mailarmor_regex_budget_exceeded_total", "counter",
+            "Emails whose regex stage ran out of time or steps.",
+            (({"reason": reason}, budget_exceeded.get(reason, 0)) for reason in ("time", "steps")))
+        if not self.enabled:
+            return lines
+
+        for key in rules.feature_keys:
+            rule_hits.setdefault(key, 0)
+        tier_hits: dict[tuple[str, str], int] = {}
+        for (category, tier, _), count in rule_hits.items():
+            tier_hits[(category, tier)] = tier_hits.get((category, tier), 0) + count
+
+        lines += format_metric(
+            "mailarmor_engine_evaluations_total", "counter", "Texts run through the rule matcher.",
+            [({}, evaluations)])
+        lines += format_metric(
+            "mailarmor_engine_stage_seconds_total", "counter", "Matcher time by stage.",
+            (({"stage": stage}, ns / 1e9) for stage, ns in stage_ns.items()))
+        lines += format_metric(
+            "mailarmor_category_eval_seconds_total", "counter",
+            "Time in each category's negation checks and regexes.",
+            (({"category": category}, ns / 1e9) for category, ns in category_ns.items()))
+        lines += format_metric(
+            "mailarmor_regex_eval_seconds_total", "counter", "Time in each regex pattern.",
+            (({"category": category, "pattern": pattern}, ns / 1e9)
+             for (category, pattern), ns in regex_ns.items()))
+        lines += format_metric(
+            "mailarmor_regex_evaluations_total", "counter", "Times each regex pattern was run.",
+            (({"category": category, "pattern": pattern}, count)
+             for (category, pattern), count in regex_evaluations.items()))
+        lines += format_metric(
+            "mailarmor_tier_hits_total", "counter", "Rule hits by category and tier.",
+            (({"category": category, "tier": tier}, count)
+             for (category, tier), count in sorted(tier_hits.items())))
+        lines += format_metric(
+            "mailarmor_rule_hits_total", "counter", "Hits per rule phrase or regex pattern.",
+            (({"category": category, "tier": tier, "rule": rule}, count)
+             for (category, tier, rule), count in sorted(rule_hits.items())))
+        return lines
+
+
+ENGINE_PROFILE = EngineProfile(PROFILE_ENGINE)
 
 
 # ---------------------------------------------------------------------------
 # Classifier
 # ---------------------------------------------------------------------------
 
-@dataclass
+@dataclass(slots=True)
 class ClassificationResult:
     label: str
     score: int
     runner_up: Optional[str]
     runner_up_score: int
-    matched_phrases: list[str]
-    all_scores: dict[str, int]
+    matched_ids: tuple[int, ...]    # rule feature ids of the winner's hits
+    category_scores: list[int]      # indexed by category id (ruleset order)
+    rules: CompiledRules = field(repr=False)
+    result_id: Optional[str] = None  # cache handle for GET /explain/{result_id}
+    regex_budget_exceeded: bool = False  # some regexes were skipped, see RegexBudget
+    truncated: bool = False  # only part of the email was scanned, see scan_window
 
+    @property
+    def matched_phrases(self) -> list[str]:
+        """Human-readable winner hits, built on demand from `matched_ids`."""
+        return [self.rules.feature_labels[feature_id] for feature_id in self.matched_ids]
 
-def classify(raw_text: str) -> ClassificationResult:
-    text = preprocess(raw_text)
-    scores: dict[str, int] = {}
-    matched: dict[str, list[str]] = {}
+    @property
+    def all_scores(self) -> dict[str, int]:
+        """Scores keyed by category name, built on demand from `category_scores`."""
+        return dict(zip(self.rules.categories, self.category_scores))
 
-    for category, rule in RULES.items():
-        score = 0
-        hits: list[str] = []
-
-        # Primary phrases
-        for phrase, weight in rule.primary:
-            if phrase in text and not has_negation_before(text, phrase):
-                score += weight
-                hits.append(f"[primary] {phrase!r}")
-
-        # Supporting phrases
-        for phrase, weight in rule.supporting:
-            if phrase in text:
-                score += weight
-                hits.append(f"[support] {phrase!r}")
-
-        # Negative phrases
-        for phrase, weight in rule.negative:
-            if phrase in text:
-                score += weight  # weight is already negative
-                hits.append(f"[negative] {phrase!r} ({weight})")
-
-        # Regex patterns
-        for pattern, weight in rule.regex_patterns:
-            if re.search(pattern, text):
-                score += weight
-                hits.append(f"[regex] {pattern!r}")
-
-        scores[category] = score
-        matched[category] = hits
-
-    # Filter by threshold
-    qualifying = {k: v for k, v in scores.items() if v >= RULES[k].threshold}
-
-    if not qualifying:
-        return ClassificationResult(
-            label="none",
-            score=0,
-            runner_up=None,
-            runner_up_score=0,
-            matched_phrases=[],
-            all_scores=scores,
-        )
 
-    sorted_cats = sorted(qualifying.items(), key=lambda x: x[1], reverse=True)
-    winner_label, winner_score = sorted_cats[0]
-    runner_up_label = sorted_cats[1][0] if len(sorted_cats) > 1 else None
-    runner_up_score = sorted_cats[1][1] if len(sorted_cats) > 1 else 0
+SCAN_HEAD_CHARS = int(os.environ.get("MAILARMOR_SCAN_HEAD_CHARS", str(256 * 1024)))  # 0 = scan whole emails
+SCAN_TAIL_CHARS = int(os.environ.get("MAILARMOR_SCAN_TAIL_CHARS", str(32 * 1024)))
+
+
+def scan_window(raw_text: str) -> tuple[str, bool]:
+    """Cut an email down to the part that is scanned; returns (text, truncated).
+
+    Emails longer than `SCAN_HEAD_CHARS` + `SCAN_TAIL_CHARS` keep only their
+    first and last characters (joined by a newline), so one huge body (inline
+    base64, long forwarded threads) costs no more than a large one. The
+    subject leads the combined text and is scanned first.
+    """
+    if SCAN_HEAD_CHARS <= 0 or len(raw_text) <= SCAN_HEAD_CHARS + SCAN_TAIL_CHARS:
+        return raw_text, False
+    tail = raw_text[len(raw_text) - SCAN_TAIL_CHARS:] if SCAN_TAIL_CHARS > 0 else ""
+    return f"{raw_text[:SCAN_HEAD_CHARS]}\n{tail}", True
+
+
+REGEX_BUDGET_MS = float(os.environ.get("MAILARMOR_REGEX_BUDGET_MS", "50"))                   # per email, 0 = off
+REGEX_MAX_SCAN_CHARS = int(os.environ.get("MAILARMOR_REGEX_MAX_SCAN_CHARS", str(4 * 1024 * 1024)))  # 0 = off
+REGEX_WINDOW = int(os.environ.get("MAILARMOR_REGEX_WINDOW", "4096"))
+REGEX_WINDOW_OVERLAP = int(os.environ.get("MAILARMOR_REGEX_WINDOW_OVERLAP", "512"))
+
+
+class RegexBudget:
+    """Time and step allowance for the regex stage of one email.
+
+    Python's `re` cannot be interrupted mid-search, so backtracking patterns
+    search texts longer than `REGEX_WINDOW` one window at a time (windows
+    overlap by `REGEX_WINDOW_OVERLAP`, so any match up to that length is seen
+    whole), and the budget is checked before every window. That bounds one
+    uninterruptible search by the window size instead of the email size. A
+    match is only accepted once `REGEX_WINDOW_OVERLAP` characters follow it,
+    so a lookahead never mistakes a window edge for the end of the text; one
+    that runs into a window's edge is re-tested from its start with the text
+    after it (`_confirm`), so long matches are not lost between windows.
+    Steps are the characters handed to backtracking searches; linear-time
+    (re2) patterns search the whole text and only count against the clock.
+    Only time spent inside searches counts, so one budget can cover an email
+    that arrives in chunks (`ClassificationSession`).
+
+    Once either allowance is spent, `exceeded` says which ("time" or
+    "steps") and every further search is skipped.
+    """
 
+    __slots__ = ("seconds_left", "chars_left", "exceeded")
+
+    def __init__(self):
+        self.seconds_left = REGEX_BUDGET_MS / 1000 if REGEX_BUDGET_MS > 0 else float("inf")
+        self.chars_left = REGEX_MAX_SCAN_CHARS if REGEX_MAX_SCAN_CHARS > 0 else float("inf")
+        self.exceeded: Optional[str] = None
+
+    def _spend(self, chars: int, started: float) -> bool:
+        if self.exceeded is None:
+            if time.perf_counter() - started > self.seconds_left:
+                self.exceeded = "time"
+            elif chars > self.chars_left:
+                self.exceeded = "steps"
+            else:
+                self.chars_left -= chars
+        return self.exceeded is None
+
+    def search(self, regex: RegexEntry, text: str) -> Optional[bool]:
+        """Whether `regex` matches `text`; None if the budget ran out first."""
+        return self.search_from(regex, text, 0, final=True)[0]
+
+    def search_from(self, regex: RegexEntry, text: str, start: int, final: bool) -> tuple[Optional[bool], int]:
+        """Search `text` for a match starting at `start` or later; returns (found, resume).
+
+        Unless `final`, more text follows `text`: a match is only accepted
+        once `REGEX_WINDOW_OVERLAP` characters follow it, and `resume` is
+        where to search again when the text has grown. `found` is None if the
+        budget ran out first.
+        """
+        started = time.perf_counter()
+        found, resume = self._search(regex, text, start, final, started)
+        self.seconds_left -= time.perf_counter() - started
+        return found, resume
+
+    def _search(self, regex: RegexEntry, text: str, start: int, final: bool,
+                started: float) -> tuple[Optional[bool], int]:
+        n = len(text)
+        window = n if regex.linear else REGEX_WINDOW
+        step = max(REGEX_WINDOW - REGEX_WINDOW_OVERLAP, 1)
+        while True:
+            end = min(start + window, n)
+            if not self._spend(0 if regex.linear else end - start, started):
+                return None, start
+            match = regex.pattern.search(text, start, end)
+            while match:
+                # Lookaheads, \b and $ see the window's end as the end of the text, so
+                # a match is only trusted when the text runs the overlap past it
+                if (end == n and final) or match.end() <= end - REGEX_WINDOW_OVERLAP:
+                    return True, n
+                confirmed = self._confirm(regex, text, match, final, started)
+                if confirmed:
+                    return True, n
+                if self.exceeded is not None:
+                    return None, start
+                if confirmed is None:
+                    return False, match.start()  # decide once more text has arrived
+                match = regex.pattern.search(text, match.start() + 1, end)
+            if end == n:
+                return False, n if final else max(n - REGEX_WINDOW_OVERLAP, start)
+            start += step
+
+    def _confirm(self, regex: RegexEntry, text: str, match: re.Match, final: bool,
+                 started: float) -> Optional[bool]:
+        """Re-test a match cut short by a window's end, anchored at its start, with the text after it.
+
+        The text handed to the retest grows (at least doubling the match) until
+        the match ends `REGEX_WINDOW_OVERLAP` before it, so a long match (a URL
+        with a padded path) costs linear time. None means the text ran out
+        before that and it is not `final`.
+        """
+        begin, match_end, n = match.start(), match.end(), len(text)
+        while True:
+            endpos = min(n, match_end + max(REGEX_WINDOW_OVERLAP, match_end - begin))
+            if not self._spend(0 if regex.linear else endpos - begin, started):
+                return False
+            retest = regex.pattern.match(text, begin, endpos)
+            if retest is None:
+                return False
+            if retest.end() <= endpos - REGEX_WINDOW_OVERLAP or (endpos == n and final):
+                return True
+            if endpos == n:
+                return None
+            match_end = retest.end()
+
+
+def match_features(text: str, rules: CompiledRules, prune: bool = False) -> tuple[list[int], Optional[str]]:
+    """Return the ids of the rule features that fire on preprocessed `text`, in rule order,
+    and which regex budget ran out, if any ("time" or "steps", see
+    `RegexBudget`). Regexes not evaluated because of the budget count as not
+    matched.
+
+    With `prune`, each category carries an upper bound on the score it can
+    still reach; once that drops below its threshold, the category's remaining
+    negation checks and regexes are skipped and none of its features are
+    returned. Pruned categories can never qualify, so the winner and runner-up
+    are unchanged — only their (sub-threshold) scores read as 0.
+    """
+    # Stage times feed the request's Server-Timing header; per-category and
+    # per-regex times are only taken when profiling
+    profiled = ENGINE_PROFILE.enabled
+    request_timing = current_timing()
+    timed = profiled or request_timing is not None
+    if timed:
+        started = time.perf_counter_ns()
+    entry_ids, occurrences = rules.match(text)
+    category_of = rules.feature_category
+    if timed:
+        scanned = time.perf_counter_ns()
+    if profiled:
+        category_ns = [0] * len(rules.categories)
+        regex_ns: list[Optional[int]] = [None] * len(rules.regexes)
+
+    if prune:
+        bound = list(rules.regex_gain)
+        for entry_id in entry_ids:
+            entry = rules.entries[entry_id]
+            bound[category_of[entry_id]] += max(entry.weight, 0) if entry.tier == "primary" else entry.weight
+        live = [b >= t for b, t in zip(bound, rules.prune_thresholds)]
+
+    features: list[int] = []
+    tokens: Optional[TokenIndex] = None
+    for entry_id in entry_ids:
+        category = category_of[entry_id]
+        if prune and not live[category]:
+            continue
+        entry = rules.entries[entry_id]
+        if entry.tier == "primary":
+            if tokens is None:
+                tokens = TokenIndex(text)
+            if profiled:
+                check_started = time.perf_counter_ns()
+                negated = has_negation_before(tokens, occurrences[entry.phrase_id])
+                category_ns[category] += time.perf_counter_ns() - check_started
+            else:
+                negated = has_negation_before(tokens, occurrences[entry.phrase_id])
+            if negated:
+                if prune:
+                    bound[category] -= max(entry.weight, 0)
+                    live[category] = bound[category] >= rules.prune_thresholds[category]
+                continue
+        features.append(entry_id)
+    if timed:
+        negation_checked = time.perf_counter_ns()
+
+    offset = len(rules.entries)
+    budget = RegexBudget()
+    for regex_id, regex in enumerate(rules.regexes):
+        category = category_of[offset + regex_id]
+        if prune and not live[category]:
+            continue
+        if profiled:
+            search_started = time.perf_counter_ns()
+            found = budget.search(regex, text)
+            elapsed = regex_ns[regex_id] = time.perf_counter_ns() - search_started
+            category_ns[category] += elapsed
+        else:
+            found = budget.search(regex, text)
+        if found:
+            features.append(offset + regex_id)
+        elif prune:
+            bound[category] -= max(regex.weight, 0)
+            live[category] = bound[category] >= rules.prune_thresholds[category]
+
+    if prune:
+        features = [feature_id for feature_id in features if live[category_of[feature_id]]]
+    if timed:
+        finished = time.perf_counter_ns()
+        if request_timing is not None:
+            request_timing.add("match", (negation_checked - started) / 1e9)
+            request_timing.add("regex", (finished - negation_checked) / 1e9)
+        if profiled:
+            stage_ns = {
+                "phrase_scan": scanned - started,
+                "negation": negation_checked - scanned,
+                "regex": finished - negation_checked,
+            }
+            ENGINE_PROFILE.record_evaluation(rules, stage_ns, category_ns, regex_ns, features)
+    if budget.exceeded is not None:
+        ENGINE_PROFILE.record_budget_exceeded(budget.exceeded)
+    return features, budget.exceeded
+
+
+def cached_features(text: str, rules: CompiledRules, prune: bool = False) -> tuple[tuple[int, ...], bool, str]:
+    """`match_features` behind `RESULT_CACHE`; also returns the result id of the cache entry.
+
+    Results that ran out of the step budget are cached too, so a repeated
+    adversarial body costs the budget only once. Results cut short by the
+    clock depend on host load, so they are not cached.
+    """
+    key = ResultCache.key(text, rules, prune)
+    cached = RESULT_CACHE.get(key)
+    if cached is None:
+        features, budget_exceeded = match_features(text, rules, prune)
+        cached = (tuple(features), budget_exceeded is not None)
+        if budget_exceeded != "time":
+            RESULT_CACHE.put(key, cached)
+    return cached[0], cached[1], ResultCache.format_key(key)
+
+
+def _record_preprocess(elapsed_ns: int, request_timing: Optional[RequestTiming]) -> None:
+    if ENGINE_PROFILE.enabled:
+        ENGINE_PROFILE.record_stage("preprocess", elapsed_ns)
+    if request_timing is not None:
+        request_timing.add("preprocess", elapsed_ns / 1e9)
+
+
+def classify(raw_text: str, rules: Optional[CompiledRules] = None, prune: bool = False) -> ClassificationResult:
+    """Classify one email. See `match_features` for what `prune` does to `all_scores`."""
+    rules = rules or get_active_rules()
+    raw_text, truncated = scan_window(raw_text)
+    request_timing = current_timing()
+    if ENGINE_PROFILE.enabled or request_timing is not None:
+        started = time.perf_counter_ns()
+        text = preprocess(raw_text)
+        _record_preprocess(time.perf_counter_ns() - started, request_timing)
+    else:
+        text = preprocess(raw_text)
+    category_of = rules.feature_category
+    weights = rules.feature_weight
+    scores = [0] * len(rules.categories)
+
+    features, budget_exceeded, result_id = cached_features(text, rules, prune)
+    for feature_id in features:
+        scores[category_of[feature_id]] += weights[feature_id]
+    return _pick_result(scores, features, rules, result_id, budget_exceeded, truncated)
+
+
+def _pick_result(scores: list[int], features: Iterable[int], rules: CompiledRules,
+                 result_id: Optional[str], budget_exceeded: bool, truncated: bool) -> ClassificationResult:
+    """Build the result for per-category `scores` from the firing `features` (in rule order)."""
+    category_of = rules.feature_category
+    thresholds = rules.category_thresholds
+
+    # Best and second-best qualifying category; ties go to the earlier category
+    winner = runner_up = -1
+    for category_id, score in enumerate(scores):
+        if score < thresholds[category_id]:
+            continue
+        if winner < 0 or score > scores[winner]:
+            winner, runner_up = category_id, winner
+        elif runner_up < 0 or score > scores[runner_up]:
+            runner_up = category_id
+
+    if winner < 0:
+        ENGINE_PROFILE.record_labels(("none",))
+        return ClassificationResult("none", 0, None, 0, (), scores, rules, result_id, budget_exceeded, truncated)
+
+    categories = rules.categories
+    ENGINE_PROFILE.record_labels((categories[winner],))
     return ClassificationResult(
-        label=winner_label,
-        score=winner_score,
-        runner_up=runner_up_label,
-        runner_up_score=runner_up_score,
-        matched_phrases=matched[winner_label],
-        all_scores=scores,
+        label=categories[winner],
+        score=scores[winner],
+        runner_up=categories[runner_up] if runner_up >= 0 else None,
+        runner_up_score=scores[runner_up] if runner_up >= 0 else 0,
+        matched_ids=tuple(feature_id for feature_id in features if category_of[feature_id] == winner),
+        category_scores=scores,
+        rules=rules,
+        result_id=result_id,
+        regex_budget_exceeded=budget_exceeded,
+        truncated=truncated,
+    )
+
+
+@dataclass
+class BatchClassificationResult:
+    """Results for a batch of emails, one row per email."""
+    score_matrix: np.ndarray        # emails x categories, columns in ruleset order
+    labels: list[str]
+    scores: np.ndarray
+    runner_up: list[Optional[str]]
+    runner_up_scores: np.ndarray
+    regex_budget_exceeded: list[bool]
+    truncated: list[bool]
+
+
+def classify_many(raw_texts: Iterable[str], rules: Optional[CompiledRules] = None,
+                  prune: bool = False) -> BatchClassificationResult:
+    """Classify many emails at once.
+
+    Matching is still done per email, but scoring, thresholding and winner /
+    runner-up selection run as NumPy operations over the whole batch. Hits
+    are kept sparse, as (email, feature) index pairs, and their weights are
+    summed straight into the emails x categories score matrix, so memory
+    grows with the number of hits, not emails x features. Emails whose
+    preprocessed text is identical are matched and scored once.
+    """
+    rules = rules or get_active_rules()
+    windows = [scan_window(raw_text) for raw_text in raw_texts]
+    unique: dict[str, int] = {}
+    started = time.perf_counter_ns()
+    inverse = [unique.setdefault(preprocess(raw_text), len(unique)) for raw_text, _ in windows]
+    _record_preprocess(time.perf_counter_ns() - started, current_timing())
+    cached = [cached_features(text, rules, prune) for text in unique]
+    matched = [features for features, _, _ in cached]
+    n_emails = len(inverse)
+    n_categories = len(rules.categories)
+
+    hit_rows = np.fromiter((row for row, features in enumerate(matched) for _ in features), dtype=np.intp)
+    hit_features = np.fromiter((feature_id for features in matched for feature_id in features), dtype=np.intp)
+    cells = hit_rows * n_categories + rules.feature_category_ids[hit_features]
+    unique_scores = np.bincount(cells, weights=rules.feature_weights[hit_features],
+                                minlength=len(matched) * n_categories)
+    unique_scores = unique_scores.round().astype(np.int64).reshape(len(matched), n_categories)
+    score_matrix = unique_scores[np.asarray(inverse, dtype=np.intp)]
+
+    # Non-qualifying categories are pushed to the bottom; argmax returns the
+    # first maximum, which keeps the RULES-order tie-breaking of classify().
+    floor = np.iinfo(np.int64).min
+    ranked = np.where(score_matrix >= rules.thresholds, score_matrix, floor)
+    rows = np.arange(n_emails)
+    winner = ranked.argmax(axis=1) if n_categories else np.zeros(n_emails, dtype=np.intp)
+    winner_scores = ranked[rows, winner]
+    ranked[rows, winner] = floor
+    second = ranked.argmax(axis=1) if n_categories else winner
+    second_scores = ranked[rows, second]
+
+    categories = rules.categories
+    has_winner = winner_scores != floor
+    has_second = has_winner & (second_scores != floor)
+    labels = [categories[i] if ok else "none" for i, ok in zip(winner.tolist(), has_winner.tolist())]
+    ENGINE_PROFILE.record_labels(labels)
+    return BatchClassificationResult(
+        score_matrix=score_matrix,
+        labels=labels,
+        scores=np.where(has_winner, winner_scores, 0),
+        runner_up=[categories[i] if ok else None for i, ok in zip(second.tolist(), has_second.tolist())],
+        runner_up_scores=np.where(has_second, second_scores, 0),
+        regex_budget_exceeded=[cached[i][1] for i in inverse],
+        truncated=[truncated for _, truncated in windows],
+    )
+
+
+# ---------------------------------------------------------------------------
+# Incremental Classification
+# ---------------------------------------------------------------------------
+
+SESSION_CONTEXT_CHARS = 64 * 1024  # most text a session keeps between chunks
+
+
+class ClassificationSession:
+    """Classify one email whose raw text arrives in chunks.
+
+    Each `feed` runs the new text through `HtmlTextStream` and continues the
+    phrase scan where the previous chunk left off (`scan_from`), so phrases
+    and tags cut by a chunk boundary are still found. Only a short tail of the
+    text is kept, cut at a token boundary: enough tokens for the negation
+    check in front of a phrase that started in an earlier chunk, and the text
+    regexes still have to search. Regexes search the new text once a window's
+    worth has arrived, and a match is only accepted once `REGEX_WINDOW_OVERLAP`
+    characters follow it, as in `RegexBudget`; one budget covers the whole
+    email. The `scan_window` policy applies too: after `SCAN_HEAD_CHARS`, only
+    the last `SCAN_TAIL_CHARS` are kept and scanned by `finish`.
+
+    Scores are kept up to date as hits arrive; a primary phrase found negated
+    later takes its weight back, like in `match_features`. `finish` returns
+    the same result `classify` gives on the whole text (unpruned, no
+    `result_id`), and can be called after any chunk.
+
+    With `early_margin`, the session decides once one category's floor (its
+    score if every primary phrase it counted is negated later and all of its
+    negative features still fire) is `early_margin` above its threshold and
+    above every other category's current score. `feed` then returns the
+    result and ignores further chunks; its scores and runner-up only cover
+    the text read so far. This approximates `classify`: the other categories
+    can still gain from text that was never read, so a full read may label
+    the email differently.
+    """
+
+    def __init__(self, rules: Optional[CompiledRules] = None, early_margin: Optional[int] = None):
+        self.rules = rules = rules or get_active_rules()
+        self.early_margin = early_margin
+        self.scores = [0] * len(rules.categories)
+        self.chars_read = 0             # raw characters fed
+        self.decided_early = False
+        self.regex_budget_exceeded = False
+        self.truncated = False
+        self.result: Optional[ClassificationResult] = None
+        # Per category, for early decisions: weight later text can still take away
+        self._loss_left = list(rules.negative_weight)    # negative features that have not fired yet
+        self._removable = [0] * len(rules.categories)   # counted positive primaries (a negation takes them back)
+        self._fired: set[int] = set()
+        self._negated: set[int] = set()  # primary entries with a negated occurrence
+        self._regex_resume = dict.fromkeys(range(len(rules.regexes)), 0)  # pending regex -> where to search on
+        self._budget = RegexBudget()
+        self._html = HtmlTextStream()
+        self._scan_state = None
+        self._length = 0                # preprocessed characters so far
+        self._context = ""              # tail of the preprocessed text
+        self._context_start = 0         # its offset in the whole text
+        self._context_tokens = NEGATION_WINDOW + rules.max_phrase_tokens + 1
+        self._tail = ""                 # raw text past the scan window head
+        self._tail_chars = 0
+
+    def feed(self, chunk: str) -> Optional[ClassificationResult]:
+        """Add the next chunk of raw text; returns the result once decided early, else None."""
+        if self.result is None:
+            head_left = SCAN_HEAD_CHARS - self.chars_read
+            self.chars_read += len(chunk)
+            if SCAN_HEAD_CHARS > 0 and len(chunk) > head_left:
+                rest = chunk[max(head_left, 0):]
+                self._tail_chars += len(rest)
+                self._tail = (self._tail + rest)[-SCAN_TAIL_CHARS:] if SCAN_TAIL_CHARS > 0 else ""
+                chunk = chunk[:max(head_left, 0)]
+            if chunk:
+                self._process(self._html.feed(chunk), final=False)
+            if self.early_margin is not None and self._decided():
+                self.decided_early = True
+                self.result = self._current_result()
+        return self.result
+
+    def finish(self) -> ClassificationResult:
+        """Classify what has been fed (the whole email if it was all fed)."""
+        if self.result is None:
+            if self._tail_chars > SCAN_TAIL_CHARS:
+                self.truncated = True
+                self._tail = "\n" + self._tail
+            self._process(self._html.feed(self._tail) + self._html.close(), final=True)
+            self.result = self._current_result()
+        return self.result
+
+    def _process(self, text: str, final: bool) -> None:
+        rules = self.rules
+        request_timing = current_timing()
+        started = time.perf_counter()
+        hits, self._scan_state = rules.automaton.scan_from(text, self._scan_state, self._length, final)
+        self._length += len(text)
+        context = self._context + text
+        base = self._context_start
+
+        tokens: Optional[TokenIndex] = None
+        for phrase_id, starts in hits.items():
+            for entry_id in rules.phrase_entries[phrase_id]:
+                entry = rules.entries[entry_id]
+                if entry.tier == "primary":
+                    if entry_id in self._negated:
+                        continue
+                    if tokens is None:
+                        tokens = TokenIndex(context)
+                    if has_negation_before(tokens, [start - base for start in starts]):
+                        self._negate(entry_id)
+                        continue
+                if entry_id not in self._fired:
+                    self._fire(entry_id)
+        matched = time.perf_counter()
+
+        # Search once a window's worth of text is new, so small chunks don't re-search the overlap
+        if self._regex_resume and (final or self._length - min(self._regex_resume.values()) >= REGEX_WINDOW):
+            offset = len(rules.entries)
+            for regex_id, resume in list(self._regex_resume.items()):
+                found, resume = self._budget.search_from(rules.regexes[regex_id], context,
+                                                         max(resume - base, 0), final)
+                if found:
+                    del self._regex_resume[regex_id]
+                    self._fire(offset + regex_id)
+                else:
+                    self._regex_resume[regex_id] = base + resume
+            if self._budget.exceeded is not None and not self.regex_budget_exceeded:
+                ENGINE_PROFILE.record_budget_exceeded(self._budget.exceeded)
+                self.regex_budget_exceeded = True
+        if request_timing is not None:
+            request_timing.add("match", matched - started)
+            request_timing.add("regex", time.perf_counter() - matched)
+
+        # Keep the last `_context_tokens` tokens, and the regex overlap in front of
+        # where the pending regexes resume (for lookbehinds); always cut at a token start
+        cut = len(context)
+        for _ in range(self._context_tokens):
+            cut = context.rfind(" ", 0, cut)
+            if cut < 0:
+                break
+        cut += 1
+        if self._regex_resume:
+            keep = min(self._regex_resume.values()) - base - REGEX_WINDOW_OVERLAP
+            if keep < cut:
+                cut = context.rfind(" ", 0, max(keep, 0)) + 1  # start of the token holding it
+        if len(context) - cut > SESSION_CONTEXT_CHARS:
+            space = context.find(" ", len(context) - SESSION_CONTEXT_CHARS)
+            cut = space + 1 if space >= 0 else len(context)
+        self._context = context[cut:]
+        self._context_start = base + cut
+
+    def _fire(self, feature_id: int) -> None:
+        self._fired.add(feature_id)
+        category = self.rules.feature_category[feature_id]
+        weight = self.rules.feature_weight[feature_id]
+        self.scores[category] += weight
+        if weight < 0:
+            self._loss_left[category] -= weight
+        elif feature_id < len(self.rules.entries) and self.rules.entries[feature_id].tier == "primary":
+            self._removable[category] += weight
+
+    def _negate(self, entry_id: int) -> None:
+        """A primary entry was found negated: it no longer counts, now or later."""
+        self._negated.add(entry_id)
+        category = self.rules.feature_category[entry_id]
+        weight = self.rules.feature_weight[entry_id]
+        if entry_id in self._fired:
+            self._fired.discard(entry_id)
+            self.scores[category] -= weight
+            if weight > 0:
+                self._removable[category] -= weight
+        elif weight < 0:
+            self._loss_left[category] -= weight
+
+    def _decided(self) -> bool:
+        """Whether one category is `early_margin` clear of its threshold and of every
+        other category's current score, counting the worst later text can do to it."""
+        margin = self.early_margin
+        scores = self.scores
+        thresholds = self.rules.category_thresholds
+        for category, score in enumerate(scores):
+            # Every primary it counted negated later, every negative feature still to come
+            floor = score - self._removable[category] + self._loss_left[category]
+            if floor < thresholds[category] + margin:
+                continue
+            if all(floor >= scores[other] + margin for other in range(len(scores)) if other != category):
+                return True
+        return False
+
+    def _current_result(self) -> ClassificationResult:
+        return _pick_result(list(self.scores), sorted(self._fired), self.rules, None,
+                            self.regex_budget_exceeded, self.truncated)
+
+
+# ---------------------------------------------------------------------------
+# Parallel Bulk Classification
+# ---------------------------------------------------------------------------
+
+BULK_WORKERS = int(os.environ.get("MAILARMOR_BULK_WORKERS", str(os.cpu_count() or 1)))
+BULK_CHUNK_BYTES = int(os.environ.get("MAILARMOR_BULK_CHUNK_BYTES", str(256 * 1024)))
+BULK_MAX_BYTES = int(os.environ.get("MAILARMOR_BULK_MAX_BYTES", str(64 * 1024 * 1024)))
+BULK_WORKER_RULESETS = int(os.environ.get("MAILARMOR_BULK_WORKER_RULESETS", "8"))  # compiled rulesets per worker
+
+_bulk_pool: Optional[ProcessPoolExecutor] = None
+_bulk_pool_version: Optional[str] = None
+_bulk_pool_lock = threading.Lock()
+_worker_base_rules: Optional[CompiledRules] = None
+_worker_rules: OrderedDict[tuple[str, str], CompiledRules] = OrderedDict()  # LRU by (version, matcher)
+
+
+def _init_bulk_worker(rules: dict[str, CategoryRule], matcher: str) -> None:
+    """Compile the pool's ruleset once per worker instead of shipping it with every chunk."""
+    global _worker_base_rules
+    _worker_base_rules = CompiledRules(rules, matcher)
+
+
+def _get_bulk_pool(rules: CompiledRules) -> tuple[ProcessPoolExecutor, str]:
+    """The shared pool and the ruleset version its workers were started with."""
+    global _bulk_pool, _bulk_pool_version
+    with _bulk_pool_lock:
+        if _bulk_pool is None:
+            # spawn: forking a process that already runs server threads is unsafe
+            _bulk_pool = ProcessPoolExecutor(
+                max_workers=BULK_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_bulk_worker,
+                initargs=(dict(rules.rules), rules.matcher),
+            )
+            _bulk_pool_version = rules.version
+        return _bulk_pool, _bulk_pool_version
+
+
+def shutdown_bulk_pool() -> None:
+    global _bulk_pool, _bulk_pool_version
+    with _bulk_pool_lock:
+        if _bulk_pool is not None:
+            _bulk_pool.shutdown(cancel_futures=True)
+            _bulk_pool = None
+            _bulk_pool_version = None
+
+
+def _classify_chunk(rules: Optional[dict[str, CategoryRule]], matcher: str, version: str, raw_texts: list[str],
+                    prune: bool) -> BatchClassificationResult:
+    """Worker side of `classify_many_parallel`.
+
+    `rules` is None when `version` is the ruleset the worker was started with;
+    any other ruleset (a reload, a tenant overlay) is sent along and kept
+    compiled in a small LRU, so bulk requests alternating between tenants
+    don't recompile on every chunk.
+    """
+    if rules is None:
+        return classify_many(raw_texts, _worker_base_rules, prune)
+    key = (version, matcher)
+    compiled = _worker_rules.get(key)
+    if compiled is None:
+        compiled = _worker_rules[key] = CompiledRules(rules, matcher)
+        while len(_worker_rules) > max(BULK_WORKER_RULESETS, 1):
+            _worker_rules.popitem(last=False)
+    else:
+        _worker_rules.move_to_end(key)
+    return classify_many(raw_texts, compiled, prune)
+
+
+def _chunk_by_size(raw_texts: list[str], chunk_bytes: int) -> list[list[str]]:
+    chunks: list[list[str]] = [[]]
+    size = 0
+    for raw_text in raw_texts:
+        if size >= chunk_bytes:
+            chunks.append([])
+            size = 0
+        chunks[-1].append(raw_text)
+        size += len(raw_text)
+    return chunks
+
+
+def classify_many_parallel(raw_texts: list[str], rules: Optional[CompiledRules] = None,
+                           prune: bool = False) -> BatchClassificationResult:
+    """`classify_many` spread over the persistent process pool.
+
+    Texts are split into chunks of roughly `BULK_CHUNK_BYTES`; a batch that
+    fits in one chunk (or a single-worker setup) is classified in-process.
+    """
+    rules = rules or get_active_rules()
+    windows = [scan_window(raw_text) for raw_text in raw_texts]  # cut before shipping texts to workers
+    chunks = _chunk_by_size([text for text, _ in windows], BULK_CHUNK_BYTES)
+    if len(chunks) == 1 or BULK_WORKERS <= 1:
+        return classify_many(raw_texts, rules, prune)
+
+    n = len(chunks)
+    for attempt in range(2):
+        pool, pool_version = _get_bulk_pool(rules)
+        rules_data = None if rules.version == pool_version else dict(rules.rules)
+        try:
+            parts = list(pool.map(_classify_chunk, [rules_data] * n, [rules.matcher] * n, [rules.version] * n,
+                                  chunks, [prune] * n))
+            break
+        except BrokenProcessPool as exc:
+            # A worker died (OOM kill, crash); the pool is unusable until it is replaced
+            print(f"Bulk worker pool broke ({exc}); restarting it.")
+            shutdown_bulk_pool()
+    else:
+        print("Bulk worker pool broke twice; classifying in-process.")
+        return classify_many(raw_texts, rules, prune)
+    labels = [label for part in parts for label in part.labels]
+    ENGINE_PROFILE.record_labels(labels)  # the workers' own counters stay in their processes
+    return BatchClassificationResult(
+        score_matrix=np.concatenate([part.score_matrix for part in parts]),
+        labels=labels,
+        scores=np.concatenate([part.scores for part in parts]),
+        runner_up=[label for part in parts for label in part.runner_up],
+        runner_up_scores=np.concatenate([part.runner_up_scores for part in parts]),
+        regex_budget_exceeded=[flag for part in parts for flag in part.regex_budget_exceeded],
+        truncated=[truncated for _, truncated in windows],
     )
 
 
@@ -523,10 +2150,23 @@ def classify(raw_text: str) -> ClassificationResult:
 # FastAPI App
 # ---------------------------------------------------------------------------
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    watcher = None
+    if RULES_FILE and RULES_WATCH_INTERVAL > 0:
+        watcher = RulesFileWatcher(RULES_FILE, RULES_WATCH_INTERVAL)
+        watcher.start()
+    yield
+    if watcher is not None:
+        watcher.stop()
+    shutdown_bulk_pool()
+
+
 app = FastAPI(
     title="Mailarmor — Request Type Classifier",
     description="Rule-based email request type classification signal for Mailarmor.",
     version="1.0.0",
+    lifespan=lifespan,
 )
 
 app.add_middleware(
@@ -536,11 +2176,61 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+MAX_REQUEST_BYTES = int(os.environ.get("MAILARMOR_MAX_REQUEST_BYTES", str(32 * 1024 * 1024)))
+BULK_MAX_REQUEST_BYTES = int(os.environ.get("MAILARMOR_BULK_MAX_REQUEST_BYTES", str(2 * BULK_MAX_BYTES)))
+
+
+class RequestSizeLimitMiddleware:
+    """ASGI middleware: 413 for request bodies over the limit of their path.
+
+    Checked on the Content-Length header before anything is read, and again
+    on the bytes received (chunked uploads), so an oversized body is never
+    buffered or handed to Pydantic.
+    """
+
+    def __init__(self, app, limits: dict[str, int]):
+        self.app = app
+        self.limits = limits
+
+    async def __call__(self, scope, receive, send):
+        limit = self.limits.get(scope["path"]) if scope["type"] == "http" else None
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+        detail = f"Request body exceeds {limit} bytes."
+        declared = dict(scope["headers"]).get(b"content-length")
+        if declared is not None and declared.isdigit() and int(declared) > limit:
+            await JSONResponse({"detail": detail}, status_code=413)(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+app.add_middleware(RequestSizeLimitMiddleware, limits={
+    "/classify": MAX_REQUEST_BYTES,
+    "/classify/bulk": BULK_MAX_REQUEST_BYTES,
+})
+
+METRICS = Registry()
+instrument_app(app, METRICS, "mailarmor")
+
 
 class EmailInput(BaseModel):
     subject: Optional[str] = ""
     body: str
     include_debug: bool = False
+    tenant_id: Optional[str] = None  # applies the tenant's rules overlay, if it has one
 
     model_config = {
         "json_schema_extra": {
@@ -562,6 +2252,15 @@ class ClassificationResponse(BaseModel):
     runner_up_score: int
     matched_phrases: list[str]
     all_scores: Optional[dict[str, int]] = None
+    result_id: Optional[str] = None
+    regex_budget_exceeded: bool = False
+    truncated: bool = False
+
+
+class ExplanationResponse(BaseModel):
+    result_id: str
+    ruleset_version: str
+    matched_phrases: dict[str, list[str]]
 
 
 class BulkEmailInput(BaseModel):
@@ -577,45 +2276,233 @@ def classify_email(payload: EmailInput):
     """
     Classify an email's request type based on its subject and body.
 
-    Returns the detected request type label, confidence score, and matched rule phrases.
-    Set `include_debug: true` to also receive scores for all categories.
+    Returns the detected request type label, confidence score and a `result_id`.
+    Set `include_debug: true` to also receive the matched rule phrases and scores
+    for all categories, or pass the `result_id` to `GET /explain/{result_id}` later.
     """
     combined_text = f"{payload.subject or ''} {payload.body}"
-    result = classify(combined_text)
+    try:
+        rules = TENANT_RULES.get(payload.tenant_id)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    result = classify(combined_text, rules, prune=not payload.include_debug)
 
     return ClassificationResponse(
         request_type=result.label,
         confidence_score=result.score,
         runner_up=result.runner_up,
         runner_up_score=result.runner_up_score,
-        matched_phrases=result.matched_phrases,
+        matched_phrases=result.matched_phrases if payload.include_debug else [],
         all_scores=result.all_scores if payload.include_debug else None,
+        result_id=result.result_id,
+        regex_budget_exceeded=result.regex_budget_exceeded,
+        truncated=result.truncated,
     )
 
 
+@app.get("/explain/{result_id}", response_model=ExplanationResponse, summary="Explain a cached classification")
+def explain(result_id: str):
+    """
+    Return the matched rule phrases, per category, behind a `result_id` from `/classify`.
+
+    Works while the result is still in the result cache and was produced by the
+    active ruleset (or a cached tenant ruleset); otherwise 404.
+    """
+    try:
+        key = ResultCache.parse_key(result_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Malformed result_id.")
+    rules = get_active_rules()
+    if key[0] != rules.version:
+        rules = TENANT_RULES.by_version(key[0])
+    cached = RESULT_CACHE.peek(key) if rules is not None else None
+    if cached is None:
+        raise HTTPException(status_code=404, detail="Result is no longer cached or was produced by another ruleset.")
+    features = cached[0]
+
+    matched: dict[str, list[str]] = {}
+    for feature_id in features:
+        category = rules.categories[rules.feature_category[feature_id]]
+        matched.setdefault(category, []).append(rules.feature_labels[feature_id])
+    return ExplanationResponse(result_id=result_id, ruleset_version=rules.version, matched_phrases=matched)
+
+
 @app.post("/classify/bulk", response_model=BulkClassificationResponse, summary="Classify multiple emails")
 def classify_bulk(payload: BulkEmailInput):
     """
-    Classify up to 100 emails in a single request.
+    Classify many emails in a single request, spread over all CPU cores.
+
+    The payload is limited by size (`MAILARMOR_BULK_MAX_BYTES` of subject + body text), not by email count.
+    Emails are batched per `tenant_id`.
     """
-    if len(payload.emails) > 100:
-        raise HTTPException(status_code=400, detail="Maximum 100 emails per bulk request.")
+    texts = [f"{email.subject or ''} {email.body}" for email in payload.emails]
+    total_bytes = sum(len(text.encode("utf-8", "surrogatepass")) for text in texts)
+    if total_bytes > BULK_MAX_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Bulk payload is {total_bytes} bytes; maximum is {BULK_MAX_BYTES} bytes per request.",
+        )
 
-    results = []
+    tenants: dict[Optional[str], list[int]] = {}
     for i, email in enumerate(payload.emails):
-        combined_text = f"{email.subject or ''} {email.body}"
-        result = classify(combined_text)
-        results.append({
-            "index": i,
-            "request_type": result.label,
-            "confidence_score": result.score,
-            "runner_up": result.runner_up,
-            "runner_up_score": result.runner_up_score,
-        })
+        tenants.setdefault(email.tenant_id, []).append(i)
+    try:
+        rulesets = {tenant_id: TENANT_RULES.get(tenant_id) for tenant_id in tenants}
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+    results: list[dict] = [{}] * len(texts)
+    for tenant_id, indexes in tenants.items():
+        batch = classify_many_parallel([texts[i] for i in indexes], rulesets[tenant_id], prune=True)
+        scores = batch.scores.tolist()
+        runner_up_scores = batch.runner_up_scores.tolist()
+        for row, i in enumerate(indexes):
+            results[i] = {
+                "index": i,
+                "request_type": batch.labels[row],
+                "confidence_score": scores[row],
+                "runner_up": batch.runner_up[row],
+                "runner_up_score": runner_up_scores[row],
+                "regex_budget_exceeded": batch.regex_budget_exceeded[row],
+                "truncated": batch.truncated[row],
+            }
 
     return BulkClassificationResponse(results=results)
 
 
+STREAM_MAX_LINE_BYTES = int(os.environ.get("MAILARMOR_STREAM_MAX_LINE_BYTES", str(16 * 1024 * 1024)))
+
+
+async def _ndjson_lines(request: Request) -> AsyncIterator[bytes]:
+    """Yield the lines of a newline-delimited request body as they arrive."""
+    partial = bytearray()  # the unfinished last line; only new chunks are searched for newlines
+    async for chunk in request.stream():
+        start = 0
+        newline = chunk.find(b"\n")
+        while newline >= 0:
+            if partial:
+                partial += chunk[start:newline]
+                yield bytes(partial)
+                partial.clear()
+            else:
+                yield chunk[start:newline]
+            start = newline + 1
+            newline = chunk.find(b"\n", start)
+        partial += chunk[start:]
+        if len(partial) > STREAM_MAX_LINE_BYTES:
+            raise ValueError(f"Line exceeds {STREAM_MAX_LINE_BYTES} bytes.")
+    if partial:
+        yield bytes(partial)
+
+
+class DuplexStreamingResponse(StreamingResponse):
+    """StreamingResponse whose body generator is still reading the request body.
+
+    Below ASGI 2.4 the stock implementation watches for client disconnects by
+    calling `receive()` itself, which steals request body messages from the
+    generator. Here the generator's own reads notice the disconnect instead.
+    """
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await self.stream_response(send)
+        except OSError:
+            # The server failed to write to a closed connection
+            raise ClientDisconnect()
+        if self.background is not None:
+            await self.background()
+
+
+@app.post("/classify/stream", summary="Classify a stream of newline-delimited JSON emails")
+async def classify_stream(request: Request):
+    """
+    Classify emails sent as NDJSON (one `EmailInput` object per line).
+
+    Each result is written back as one NDJSON line as soon as its email is
+    scored, so memory use stays constant however long the stream is. A line
+    that is not a valid email produces an `error` line and the stream goes on.
+    """
+    async def results() -> AsyncIterator[str]:
+        index = 0
+        try:
+            async for line in _ndjson_lines(request):
+                if not line.strip():
+                    continue
+                try:
+                    email = EmailInput.model_validate_json(line)
+                    rules = TENANT_RULES.get(email.tenant_id)
+                except ValidationError as exc:
+                    out = {"index": index, "error": exc.errors(include_url=False, include_context=False, include_input=False)}
+                except ValueError as exc:
+                    out = {"index": index, "error": str(exc)}
+                else:
+                    result = await run_in_threadpool(classify, f"{email.subject or ''} {email.body}", rules, True)
+                    out = {
+                        "index": index,
+                        "request_type": result.label,
+                        "confidence_score": result.score,
+                        "runner_up": result.runner_up,
+                        "runner_up_score": result.runner_up_score,
+                        "regex_budget_exceeded": result.regex_budget_exceeded,
+                        "truncated": result.truncated,
+                    }
+                index += 1
+                yield json.dumps(out) + "\n"
+        except ValueError as exc:
+            yield json.dumps({"index": index, "error": str(exc)}) + "\n"
+        except ClientDisconnect:
+            return
+
+    return DuplexStreamingResponse(results(), media_type="application/x-ndjson")
+
+
+class ChunkedClassificationResponse(ClassificationResponse):
+    decided_early: bool
+    bytes_read: int
+
+
+@app.post("/classify/chunked", response_model=ChunkedClassificationResponse,
+          summary="Classify one email body while it is being uploaded")
+async def classify_chunked(request: Request, subject: str = "", early_margin: Optional[int] = None,
+                           include_debug: bool = False, tenant_id: Optional[str] = None):
+    """
+    Classify one email whose raw body (text or HTML, UTF-8) is the request body.
+
+    The body is classified chunk by chunk as it arrives (`ClassificationSession`),
+    so it never has to be buffered. With `early_margin`, reading stops once one
+    category is clearly ahead (an approximation of a full read, see
+    `ClassificationSession`); `bytes_read` says how much was read.
+    """
+    try:
+        rules = TENANT_RULES.get(tenant_id)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    session = ClassificationSession(rules, early_margin=early_margin)
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    session.feed(f"{subject} ")
+    bytes_read = 0
+    async for chunk in request.stream():
+        bytes_read += len(chunk)
+        if await run_in_threadpool(session.feed, decoder.decode(chunk)) is not None:
+            break
+    else:
+        session.feed(decoder.decode(b"", final=True))
+    result = await run_in_threadpool(session.finish)
+
+    return ChunkedClassificationResponse(
+        request_type=result.label,
+        confidence_score=result.score,
+        runner_up=result.runner_up,
+        runner_up_score=result.runner_up_score,
+        matched_phrases=result.matched_phrases if include_debug else [],
+        all_scores=result.all_scores if include_debug else None,
+        regex_budget_exceeded=result.regex_budget_exceeded,
+        truncated=result.truncated,
+        decided_early=session.decided_early,
+        bytes_read=bytes_read,
+    )
+
+
 @app.get("/categories", summary="List all supported request type categories")
 def list_categories():
     """Returns all supported request type labels with their descriptions."""
@@ -761,9 +2648,74 @@ def get_samples():
     }
 
 
+@app.get("/cache/stats", summary="Result cache counters")
+def cache_stats():
+    """Size, hit/miss counters and evictions of the in-process result cache."""
+    return RESULT_CACHE.stats()
+
+
+def _cache_metrics() -> list[str]:
+    stats = RESULT_CACHE.stats()
+    lines = format_metric("mailarmor_result_cache_entries", "gauge", "Entries in the result cache.",
+                          [({}, stats["size"])])
+    for counter in ("hits", "misses", "evictions", "expirations"):
+        lines += format_metric(f"mailarmor_result_cache_{counter}_total", "counter",
+                               f"Result cache {counter}.", [({}, stats[counter])])
+    stats = TENANT_RULES.stats()
+    lines += format_metric("mailarmor_tenant_rules_cache_entries", "gauge", "Compiled tenant rulesets cached.",
+                           [({}, stats["size"])])
+    for counter in ("hits", "misses", "evictions"):
+        lines += format_metric(f"mailarmor_tenant_rules_cache_{counter}_total", "counter",
+                               f"Tenant ruleset cache {counter}.", [({}, stats[counter])])
+    return lines
+
+
+METRICS.register(lambda: ENGINE_PROFILE.collect(get_active_rules()))
+METRICS.register(_cache_metrics)
+
+
+@app.get("/metrics", response_class=PlainTextResponse, summary="Prometheus metrics")
+def metrics():
+    """
+    Engine counters in the Prometheus text format.
+
+    Label outcomes and result cache counters are always exported; per-stage,
+    per-category, per-regex timings and per-rule hit counts need
+    `MAILARMOR_PROFILE=1`.
+    """
+    return PlainTextResponse(METRICS.render(), media_type=METRICS_CONTENT_TYPE)
+
+
+@app.post("/rules/reload", summary="Recompile the rules file and swap it in")
+def reload_rules_endpoint():
+    """
+    Recompile the rules from `MAILARMOR_RULES_FILE` (or the built-in rules) and make them active.
+
+    Requests already running finish on the previous ruleset. If the file is
+    missing or invalid, the active ruleset is kept and 400 is returned.
+    """
+    try:
+        compiled = reload_rules()
+    except (OSError, ValueError) as exc:
+        raise HTTPException(status_code=400, detail=f"Rules reload failed: {exc}")
+    return {
+        "ruleset_version": compiled.version,
+        "ruleset_compiled_at": compiled.compiled_at.isoformat(),
+        "rules_loaded": len(compiled.categories),
+        "matcher": compiled.matcher,
+    }
+
+
 @app.get("/health", summary="Health check")
 def health():
-    return {"status": "ok", "rules_loaded": len(RULES)}
+    rules = get_active_rules()
+    return {
+        "status": "ok",
+        "rules_loaded": len(rules.categories),
+        "ruleset_version": rules.version,
+        "ruleset_compiled_at": rules.compiled_at.isoformat(),
+        "matcher": rules.matcher,
+    }
 
 
 # ---------------------------------------------------------------------------
@@ -0,0 +1,276 @@
+"""
+Prometheus Text Metrics
+=======================
+Metric families rendered in the Prometheus text exposition format, plus
+per-request latency histograms and a Server-Timing header for the FastAPI
+apps. No client library needed.
+"""
+
+from __future__ import annotations
+
+import functools
+import inspect
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterable, Iterator, Optional
+
+from fastapi import FastAPI
+from fastapi.routing import APIRoute
+from starlette.datastructures import MutableHeaders
+from starlette.routing import Match
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def format_sample(name: str, labels: dict[str, str], value: float) -> str:
+    if labels:
+        label_text = ",".join(f'{key}="{_escape(val)}"' for key, val in labels.items())
+        return f"{name}{{{label_text}}} {_format_value(value)}"
+    return f"{name} {_format_value(value)}"
+
+
+def format_metric(name: str, kind: str, help_text: str,
+                  samples: Iterable[tuple[dict[str, str], float]]) -> list[str]:
+    """Render one metric family: HELP and TYPE lines followed by its samples."""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    lines.extend(format_sample(name, labels, value) for labels, value in samples)
+    return lines
+
+
+class Registry:
+    """A set of collectors; each returns the text lines of its metric families."""
+
+    def __init__(self):
+        self._collectors: list[Callable[[], list[str]]] = []
+
+    def register(self, collector: Callable[[], list[str]]) -> None:
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines: list[str] = []
+        for collector in self._collectors:
+            lines.extend(collector())
+        return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Counter:
+    """A monotonically increasing count per label combination."""
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values: dict[tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def collect(self) -> list[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return format_metric(self.name, "counter", self.help_text,
+                             [(dict(zip(self.labelnames, labelvalues)), value) for labelvalues, value in items])
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count per label combination."""
+
+    LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series: dict[tuple[str, ...], list] = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labelvalues: str) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [0] * len(self.buckets) + [0.0, 0]
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def collect(self) -> list[str]:
+        with self._lock:
+            items = [(labels, list(series)) for labels, series in sorted(self._series.items())]
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labelvalues, series in items:
+            labels = dict(zip(self.labelnames, labelvalues))
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(format_sample(f"{self.name}_bucket", {**labels, "le": repr(bound)}, cumulative))
+            lines.append(format_sample(f"{self.name}_bucket", {**labels, "le": "+Inf"}, series[-1]))
+            lines.append(format_sample(f"{self.name}_sum", labels, series[-2]))
+            lines.append(format_sample(f"{self.name}_count", labels, series[-1]))
+        return lines
+
+
+# ---------------------------------------------------------------------------
+# Request Timing
+# ---------------------------------------------------------------------------
+
+class RequestTiming:
+    """Where the time of one request went, reported in its Server-Timing header.
+
+    `parse` is everything before the endpoint function runs (body read and
+    validation), `serialize` everything after it returns. Code in between
+    adds named phases with `timing_phase` or `RequestTiming.add`.
+    """
+
+    __slots__ = ("started", "phases", "handler_started", "handler_finished")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: dict[str, float] = {}
+        self.handler_started: Optional[float] = None
+        self.handler_finished: Optional[float] = None
+
+    def add(self, phase: str, seconds: float) -> None:
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def server_timing(self, now: float) -> str:
+        phases: dict[str, float] = {}
+        if self.handler_started is not None:
+            phases["parse"] = self.handler_started - self.started
+        phases.update(self.phases)
+        if self.handler_finished is not None:
+            phases["serialize"] = now - self.handler_finished
+        phases["total"] = now - self.started
+        return ", ".join(f"{phase};dur={seconds * 1000:.3f}" for phase, seconds in phases.items())
+
+
+_request_timing: ContextVar[Optional[RequestTiming]] = ContextVar("request_timing", default=None)
+
+
+def current_timing() -> Optional[RequestTiming]:
+    """The timing of the request being handled, or None outside a request."""
+    return _request_timing.get()
+
+
+@contextmanager
+def timing_phase(phase: str) -> Iterator[None]:
+    """Add the time spent in the block to `phase` of the current request, if any."""
+    timing = _request_timing.get()
+    if timing is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing.add(phase, time.perf_counter() - started)
+
+
+class TimedRoute(APIRoute):
+    """APIRoute that marks when its endpoint function starts and returns."""
+
+    def get_route_handler(self):
+        endpoint = self.dependant.call
+
+        if inspect.iscoroutinefunction(endpoint):
+            @functools.wraps(endpoint)
+            async def timed_endpoint(*args, **kwargs):
+                timing = _request_timing.get()
+                if timing is None:
+                    return await endpoint(*args, **kwargs)
+                timing.handler_started = time.perf_counter()
+                try:
+                    return await endpoint(*args, **kwargs)
+                finally:
+                    timing.handler_finished = time.perf_counter()
+        else:
+            @functools.wraps(endpoint)
+            def timed_endpoint(*args, **kwargs):
+                timing = _request_timing.get()
+                if timing is None:
+                    return endpoint(*args, **kwargs)
+                timing.handler_started = time.perf_counter()
+                try:
+                    return endpoint(*args, **kwargs)
+                finally:
+                    timing.handler_finished = time.perf_counter()
+
+        self.dependant.call = timed_endpoint
+        return super().get_route_handler()
+
+
+class RequestTimingMiddleware:
+    """ASGI middleware: latency histogram per endpoint and a Server-Timing header.
+
+    The header is written when the response starts, so for streaming
+    responses it only covers the time until the first byte; the histogram
+    always covers the whole request.
+    """
+
+    def __init__(self, app, histogram: Histogram, routes: list):
+        self.app = app
+        self.histogram = histogram
+        self.routes = routes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timing = RequestTiming()
+        token = _request_timing.set(timing)
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                MutableHeaders(scope=message).append("Server-Timing", timing.server_timing(time.perf_counter()))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_timing.reset(token)
+            # Route templates, not raw paths, keep the label set bounded
+            self.histogram.observe(time.perf_counter() - timing.started, scope["method"],
+                                   self._route_template(scope), str(status))
+
+    def _route_template(self, scope) -> str:
+        partial = "unmatched"
+        for route in self.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+            if match == Match.PARTIAL and partial == "unmatched":
+                partial = route.path
+        return partial
+
+
+def instrument_app(app: FastAPI, registry: Registry, prefix: str) -> None:
+    """Add request latency histograms and Server-Timing to `app`. Call before defining routes."""
+    app.router.route_class = TimedRoute
+    histogram = Histogram(f"{prefix}_http_request_duration_seconds",
+                          "Request latency by endpoint, from request start to the last response byte.",
+                          ("method", "route", "status"))
+    registry.register(histogram.collect)
+    app.add_middleware(RequestTimingMiddleware, histogram=histogram, routes=app.router.routes)
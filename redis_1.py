@@ -1,21 +1,139 @@
 import redis
+import redis.asyncio
 
-from auto import classify_email
+from auto import LLM_FLIGHTS, LLM_MODEL, PROMPT_VERSION, agent2, agent2_async, classify_email_async
+from mailarmor_classifier import preprocess
+from metrics import Counter, Histogram, timing_phase
+import asyncio
 import datetime
+import hashlib
+import os
+import time
 
-r = redis.Redis(host="localhost", port=6379, db=0, decode_responses=True)
+REDIS_URL = os.environ.get("MAILARMOR_REDIS_URL", "redis://localhost:6379/0")
+REDIS_MAX_CONNECTIONS = int(os.environ.get("MAILARMOR_REDIS_MAX_CONNECTIONS", "64"))
+REDIS_TIMEOUT = float(os.environ.get("MAILARMOR_REDIS_TIMEOUT", "2"))  # seconds, per command
 
+# Verdict cache client (worker threads); an unreachable Redis fails fast and
+# counts as a cache miss instead of stalling the request
+r = redis.Redis.from_url(REDIS_URL, socket_timeout=REDIS_TIMEOUT, socket_connect_timeout=REDIS_TIMEOUT,
+                         decode_responses=True)
 
-def get_value(id):
+# Message bodies and the verdicts of /process are read on the event loop
+# through a pooled asyncio client;
+# redis-py parses replies with hiredis when it is installed (redis[hiredis]).
+message_store = redis.asyncio.Redis(connection_pool=redis.asyncio.ConnectionPool.from_url(
+    REDIS_URL,
+    max_connections=REDIS_MAX_CONNECTIONS,
+    socket_timeout=REDIS_TIMEOUT,
+    socket_connect_timeout=REDIS_TIMEOUT,
+    decode_responses=True,
+    encoding_errors="replace",
+))
+FETCH_LATENCY = Histogram("request_type_message_fetch_seconds",
+                          "Time to read a message body from Redis, by result (found, missing, error).",
+                          ("result",))
+
+
+class MessageNotFound(KeyError):
+    """No message body is stored under the requested id."""
+
+# LLM verdicts shared by all replicas, so a body is sent to Ollama once per TTL
+VERDICT_TTL = int(os.environ.get("MAILARMOR_VERDICT_TTL", "86400"))  # seconds
+VERDICT_CACHE = Counter("request_type_verdict_cache_lookups_total",
+                        "LLM verdict lookups in Redis by result (hit, miss, error).", ("result",))
+
+
+def verdict_key(email_text):
+    """Redis key of the LLM verdict for this text, model and prompt version."""
+    content = f"{LLM_MODEL}\0{PROMPT_VERSION}\0{preprocess(email_text)}"
+    return "request_type:verdict:" + hashlib.sha256(content.encode("utf-8", "surrogatepass")).hexdigest()
+
+
+def cached_agent2(email_text):
+    """agent2() behind the Redis verdict cache; Redis errors fall through to the LLM.
+
+    Concurrent calls for the same key are coalesced: one checks the cache
+    and calls the LLM, the others wait for its verdict.
+    """
+    key = verdict_key(email_text)
+    return LLM_FLIGHTS.do(key, _cached_agent2, key, email_text)
+
+
+def _cached_agent2(key, email_text):
+    try:
+        verdict = r.get(key)
+    except redis.RedisError as exc:
+        print("verdict cache read failed:", exc)
+        VERDICT_CACHE.inc("error")
+    else:
+        if verdict is not None:
+            VERDICT_CACHE.inc("hit")
+            return verdict
+        VERDICT_CACHE.inc("miss")
+
+    verdict = agent2(email_text)
+    try:
+        r.set(key, verdict, ex=VERDICT_TTL)
+    except redis.RedisError as exc:
+        print("verdict cache write failed:", exc)
+    return verdict
+
+
+async def cached_agent2_async(email_text):
+    """cached_agent2() for the event loop, on the asyncio Redis client and dispatcher."""
+    key = await asyncio.to_thread(verdict_key, email_text)  # preprocesses the whole body
+    return await LLM_FLIGHTS.ado(key, _cached_agent2_async, key, email_text)
+
+
+async def _cached_agent2_async(key, email_text):
+    try:
+        verdict = await message_store.get(key)
+    except redis.RedisError as exc:
+        print("verdict cache read failed:", exc)
+        VERDICT_CACHE.inc("error")
+    else:
+        if verdict is not None:
+            VERDICT_CACHE.inc("hit")
+            return verdict
+        VERDICT_CACHE.inc("miss")
+
+    verdict = await agent2_async(email_text)
+    try:
+        await message_store.set(key, verdict, ex=VERDICT_TTL)
+    except redis.RedisError as exc:
+        print("verdict cache write failed:", exc)
+    return verdict
+
+
+async def fetch_message(id):
+    """Read the message body stored under `id`; raises MessageNotFound if there is none."""
+    started = time.perf_counter()
+    result = "error"
+    try:
+        with timing_phase("fetch"):
+            body = await message_store.get(id)
+        result = "missing" if body is None else "found"
+    finally:
+        FETCH_LATENCY.observe(time.perf_counter() - started, result)
+    if body is None:
+        raise MessageNotFound(id)
+    return body
+
+
+async def get_value(id, tenant_id=None):
     # strat = datetime.datetime.now()
     # print("#message_fetch_redis#start#" + str(strat))
-    # r = redis.Redis(host="localhost", port=6379, db=0, decode_responses=True)
-
-    # outp = r.get(id)
+    outp = await fetch_message(id)
     # end = datetime.datetime.now()
     # print("#message_fetch_redis#end#" + str(end))
     # print("total time taken by redis = ", (end - strat))
-    return classify_email(id)
+    # Only the rule engine runs in a worker thread; the LLM call is awaited
+    return await classify_email_async(outp, tenant_id, cached_agent2_async)
+
+
+async def close():
+    await message_store.aclose()
 
 
 # s = get_value(
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Regression checks for the rule engine, run in-process (no server needed):
+
+    python3 test_engine.py        # or: python3 -m pytest test_engine.py
+"""
+
+import random
+
+import mailarmor_classifier as engine
+from benchmark import build_corpus
+
+
+LINK_REGEX = "[regex] 'https?://(?!(?:www\\\\.)?(microsoft|google|apple|amazon)\\\\.com)[^\\\\s]{15,}'"
+
+
+def test_long_url_regex():
+    """A URL whose path runs past a regex window still matches the link regex."""
+    rules = engine.get_active_rules()
+    for path_length in (100, engine.REGEX_WINDOW + 1000, 20000):
+        text = engine.preprocess(f"Please review https://billing-update.example.net/{'a' * path_length} today")
+        features, budget_exceeded = engine.match_features(text, rules)
+        assert budget_exceeded is None, path_length
+        assert LINK_REGEX in [rules.feature_labels[feature_id] for feature_id in features], path_length
+
+        session = engine.ClassificationSession(rules)
+        for start in range(0, len(text), 700):
+            session.feed(text[start:start + 700])
+        assert session.finish().category_scores == engine.classify(text, rules).category_scores, path_length
+
+
+def test_chunked_session_matches_classify():
+    """Feeding an email in random chunks gives the same result as classifying it whole."""
+    texts = [text for _, text in build_corpus(60, {"short": 0.4, "long": 0.3, "html": 0.3}, 20000, seed=5)]
+    rnd = random.Random(1)
+    rules = engine.get_active_rules()
+    budget_ms, engine.REGEX_BUDGET_MS = engine.REGEX_BUDGET_MS, 0  # timing must not change results
+    try:
+        for compiled in (rules, engine.CompiledRules(dict(rules.rules), "ngram")):
+            for text in texts:
+                expected = engine.classify(text, compiled)
+                for _ in range(2):
+                    session = engine.ClassificationSession(compiled)
+                    start = 0
+                    while start < len(text):
+                        size = rnd.choice([1, 2, 3, 7, 50, 500, 5000])
+                        session.feed(text[start:start + size])
+                        start += size
+                    result = session.finish()
+                    for attr in ("label", "score", "runner_up", "runner_up_score", "matched_ids", "category_scores"):
+                        assert getattr(result, attr) == getattr(expected, attr), (compiled.matcher, attr, text[:80])
+    finally:
+        engine.REGEX_BUDGET_MS = budget_ms
+
+
+def test_early_decision():
+    """A category carried by supporting phrases alone is decided before the end of the text."""
+    rules = engine.get_active_rules()
+    gift = rules.rules["gift_card_request"]
+    text = " ".join(phrase for phrase, _ in gift.primary + gift.supporting) + " lorem ipsum" * 2000
+    session = engine.ClassificationSession(rules, early_margin=5)
+    result = None
+    for start in range(0, len(text), 200):
+        result = session.feed(text[start:start + 200])
+        if result is not None:
+            break
+    assert result is not None and session.decided_early
+    assert result.label == engine.classify(text, rules).label == "gift_card_request"
+    assert session.chars_read < len(text)
+
+
+if __name__ == "__main__":
+    tests = [(name, test) for name, test in globals().items() if name.startswith("test_")]
+    for name, test in tests:
+        test()
+        print(f"✅ {name}")
+    print(f"\n{len(tests)} checks passed")